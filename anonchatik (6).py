@@ -1,10 +1,19 @@
 import telebot
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
 import sqlite3
 import sys
 import os
+import queue
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import islice
 from datetime import datetime
 from html import escape
 
@@ -62,35 +71,44 @@ def _warn_missing_creator_column(column_name):
     _CREATOR_MISSING_COLUMN_WARNINGS.add(column_name)
 
 
-def get_bot_setting_from_creator(bot_id, setting_name, default_value=None):
-    """Получает настройку бота из БД Creator"""
-    global _CREATOR_BOTS_COLUMNS_CACHE
-    if not _creator_table_has_column(setting_name):
-        _warn_missing_creator_column(setting_name)
-        return default_value
+_CREATOR_SETTINGS = None
+
+
+def _load_all_creator_settings(bot_id):
+    """Читает строку бота из Creator БД одним запросом и кэширует её как словарь."""
+    global _CREATOR_SETTINGS
+    if _CREATOR_SETTINGS is not None:
+        return _CREATOR_SETTINGS
+    columns = sorted(_load_creator_bots_columns())
+    if not columns:
+        _CREATOR_SETTINGS = {}
+        return _CREATOR_SETTINGS
     conn = None
     try:
         conn = sqlite3.connect(CREATOR_DB_PATH)
         cursor = conn.cursor()
-        cursor.execute(f"SELECT {setting_name} FROM bots WHERE id = ?", (bot_id,))
-        result = cursor.fetchone()
-        if result and result[0] is not None:
-            return result[0]
-        return default_value
-    except sqlite3.OperationalError as e:
-        if "no such column" in str(e).lower():
-            # Таблица изменилась после кэширования — сбросим кэш и вернём default.
-            _CREATOR_BOTS_COLUMNS_CACHE = None
-            _warn_missing_creator_column(setting_name)
-            return default_value
-        print(f"Ошибка получения настройки {setting_name}: {e}")
-        return default_value
+        select_list = ', '.join(f'"{name}"' for name in columns)
+        cursor.execute(f"SELECT {select_list} FROM bots WHERE id = ?", (bot_id,))
+        row = cursor.fetchone()
+        _CREATOR_SETTINGS = dict(zip(columns, row)) if row else {}
     except Exception as e:
-        print(f"Ошибка получения настройки {setting_name}: {e}")
-        return default_value
+        print(f"Ошибка получения настроек бота #{bot_id} из Creator БД: {e}")
+        _CREATOR_SETTINGS = {}
     finally:
         if conn:
             conn.close()
+    return _CREATOR_SETTINGS
+
+
+def get_bot_setting_from_creator(bot_id, setting_name, default_value=None):
+    """Получает настройку бота из БД Creator"""
+    if not _creator_table_has_column(setting_name):
+        _warn_missing_creator_column(setting_name)
+        return default_value
+    value = _load_all_creator_settings(bot_id).get(setting_name)
+    if value is None:
+        return default_value
+    return value
 
 # Загружаем настройки из Creator БД
 TOKEN = get_bot_setting_from_creator(BOT_ID, 'bot_token', '')
@@ -105,23 +123,17 @@ except ValueError:
     FLYER_TASKS_LIMIT = 5
 
 
+_ADMIN_ID_SEPARATORS = str.maketrans({';': ','})
+
+
 def _parse_admin_ids(raw_value):
-    ids = set()
     if not raw_value:
-        return ids
-    cleaned = str(raw_value).replace(';', ',')
-    for chunk in cleaned.split(','):
-        token = chunk.strip()
-        if not token:
-            continue
-        if token.startswith('+'):
-            token = token[1:]
-        if token.lstrip('-').isdigit():
-            try:
-                ids.add(int(token))
-            except ValueError:
-                continue
-    return ids
+        return frozenset()
+    tokens = (chunk.strip().lstrip('+') for chunk in str(raw_value).translate(_ADMIN_ID_SEPARATORS).split(','))
+    return frozenset(
+        int(token) for token in tokens
+        if token and (token[1:] if token[0] == '-' else token).isdecimal()
+    )
 
 
 ADMIN_IDS = _parse_admin_ids(os.getenv('ADMIN_IDS'))
@@ -148,6 +160,8 @@ if not ADMIN_IDS:
     # Последний резерв — вручную пропишите свой ID здесь, если нигде больше не задан.
     ADMIN_IDS = {6745031200}
 
+ADMIN_IDS = frozenset(ADMIN_IDS)
+
 def normalize_channel(raw_value: str) -> str:
     if not raw_value:
         return ''
@@ -166,6 +180,7 @@ CHANNEL_ID = normalize_channel(RAW_CHANNEL_ID)
 CHANNEL_USERNAME = CHANNEL_ID[1:] if CHANNEL_ID.startswith('@') else CHANNEL_ID
 SUBSCRIPTION_REQUIRED = bool(CHANNEL_ID)
 DEFAULT_SEARCH_GENDER = "Любой"
+GENDER_CHOICES = ("Мальчик", "Девочка")
 
 def _resolve_creator_username() -> str:
     """Возвращает @username конструктора в нормализованном виде."""
@@ -180,11 +195,9 @@ def _resolve_creator_username() -> str:
     return username
 
 
-def _build_creator_branding_text() -> str:
-    handle = _resolve_creator_username()
-    if not handle:
-        return ""
-    return f"Создан с помощью {handle}"
+# Значения зависят только от CREATOR_USERNAME, поэтому вычисляются один раз
+CREATOR_HANDLE = _resolve_creator_username()
+CREATOR_BRANDING_TEXT = f"Создан с помощью {CREATOR_HANDLE}" if CREATOR_HANDLE else ""
 
 if not TOKEN:
     print(f"ОШИБКА: Токен бота #{BOT_ID} не найден в БД Creator!")
@@ -194,21 +207,57 @@ bot = telebot.TeleBot(TOKEN)
 
 # Словари для хранения данных
 chat_partners = {}  # Для активных пар
-waiting_users = set()  # Для ожидания
-user_data = {}  # Для хранения данных пользователей: пол, премиум-статус
+# Связанные методы: без поиска атрибута на каждое сообщение
+_cp_get = chat_partners.get
+_cp_pop = chat_partners.pop
+_waiting_by_key = defaultdict(deque)  # Очередь ожидания по ключу (пол, искомый пол)
+_user_bucket = {}  # user_id -> ключ очереди, в которой он ждёт
+user_data = {}  # user_id -> UserRec: пол, премиум-статус, искомый пол, бан
 user_states = {}  # Для состояний админских действий
 user_invoices = {}  # Для хранения инвойсов пользователей
-last_check_time = {}  # Время последней проверки статуса
+last_check_time = {}  # Время последней проверки статуса (по time.monotonic())
+PAYMENT_CHECK_COOLDOWN = 300  # секунд между проверками статуса инвойса
+
+# Блокировки: полосатые (по user_id) для пар и инвойсов, одна общая — для очереди поиска
+_STRIPES = [threading.Lock() for _ in range(16)]
+_WAITING_LOCK = threading.Lock()
+
+
+def _lk(user_id):
+    return _STRIPES[user_id & 15]
+
+
+@contextmanager
+def _locked_pair(user_a, user_b):
+    """Берёт блокировки обоих пользователей в фиксированном порядке, чтобы избежать взаимоблокировки."""
+    locks = sorted({id(lock): lock for lock in (_lk(user_a), _lk(user_b))}.items())
+    for _, lock in locks:
+        lock.acquire()
+    try:
+        yield
+    finally:
+        for _, lock in reversed(locks):
+            lock.release()
+
+
+SUBSCRIPTION_CACHE_TTL = 60  # секунд
+_SUB_CACHE = {}  # user_id -> (время проверки по monotonic, подписан ли)
+
 
 # Проверка подписки
 def check_subscription(user_id):
     if not SUBSCRIPTION_REQUIRED:
         return True
+    checked_at, subscribed = _SUB_CACHE.get(user_id, (0.0, None))
+    if subscribed is not None and time.monotonic() - checked_at < SUBSCRIPTION_CACHE_TTL:
+        return subscribed
     try:
         member = bot.get_chat_member(CHANNEL_ID, user_id)
-        return member.status in ['member', 'administrator', 'creator']
     except Exception:
         return False
+    subscribed = member.status in ['member', 'administrator', 'creator']
+    _SUB_CACHE[user_id] = (time.monotonic(), subscribed)
+    return subscribed
 # Путь к БД пользователей бота
 USER_DB_PATH = f'dbs/bot_{BOT_ID}_anonchat.db'
 
@@ -216,66 +265,133 @@ USER_DB_PATH = f'dbs/bot_{BOT_ID}_anonchat.db'
 if not os.path.exists('dbs'):
     os.makedirs('dbs')
 
+# Пул соединений с БД пользователей: обработчики переиспользуют «тёплые» соединения
+_USER_DB_POOL = queue.LifoQueue(maxsize=8)
+
+
+def _open_user_conn():
+    conn = sqlite3.connect(USER_DB_PATH, check_same_thread=False)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-64000")
+    return conn
+
+
+@contextmanager
+def get_user_conn():
+    """Выдаёт соединение из пула; по выходу фиксирует транзакцию и возвращает соединение в пул."""
+    try:
+        conn = _USER_DB_POOL.get_nowait()
+    except queue.Empty:
+        conn = _open_user_conn()
+    try:
+        yield conn
+        if conn.in_transaction:
+            conn.commit()
+    except Exception:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+    finally:
+        try:
+            _USER_DB_POOL.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
 def ensure_user_record(user_id):
-    conn = sqlite3.connect(USER_DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        'INSERT OR IGNORE INTO users (user_id, search_gender) VALUES (?, ?)',
-        (user_id, DEFAULT_SEARCH_GENDER)
-    )
-    conn.commit()
-    conn.close()
+    with get_user_conn() as conn:
+        conn.execute(
+            'INSERT OR IGNORE INTO users (user_id, search_gender) VALUES (?, ?)',
+            (user_id, DEFAULT_SEARCH_GENDER)
+        )
+
+
+class UserRec:
+    """Кэшированная запись пользователя: __slots__ вместо словаря на каждого."""
+    __slots__ = ("gender", "premium", "search_gender", "banned")
+
+    def __init__(self, gender=None, premium=False, search_gender=None, banned=False):
+        self.gender = gender
+        self.premium = bool(premium)
+        self.search_gender = search_gender or DEFAULT_SEARCH_GENDER
+        self.banned = bool(banned)
+
+
+# Запись по умолчанию для ещё не загруженных пользователей — только для чтения
+_NO_USER = UserRec()
+
+
+def _cache_user_row(user_id, row):
+    user_data[user_id] = UserRec(*row) if row else UserRec()
 
 
 def refresh_user_cache(user_id):
-    conn = sqlite3.connect(USER_DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('SELECT gender, premium, search_gender FROM users WHERE user_id = ?', (user_id,))
-    row = cursor.fetchone()
-    conn.close()
-    if row:
-        user_data[user_id] = {
-            "gender": row[0],
-            "premium": bool(row[1]),
-            "search_gender": row[2] or DEFAULT_SEARCH_GENDER
-        }
-    else:
-        user_data[user_id] = {
-            "gender": None,
-            "premium": False,
-            "search_gender": DEFAULT_SEARCH_GENDER
-        }
+    with get_user_conn() as conn:
+        row = conn.execute(
+            'SELECT gender, premium, search_gender, banned FROM users WHERE user_id = ?', (user_id,)
+        ).fetchone()
+    _cache_user_row(user_id, row)
+
+
+# RETURNING доступен начиная с SQLite 3.35
+_SQLITE_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
 
 
 def ensure_user_loaded(user_id):
-    ensure_user_record(user_id)
-    if user_id not in user_data:
+    if user_id in user_data:
+        return
+    if not _SQLITE_HAS_RETURNING:
+        ensure_user_record(user_id)
         refresh_user_cache(user_id)
+        return
+    with get_user_conn() as conn:
+        row = conn.execute(
+            '''INSERT INTO users (user_id, search_gender) VALUES (?, ?)
+               ON CONFLICT(user_id) DO UPDATE SET user_id = user_id
+               RETURNING gender, premium, search_gender, banned''',
+            (user_id, DEFAULT_SEARCH_GENDER)
+        ).fetchone()
+    _cache_user_row(user_id, row)
+
+
+_UPSERT_USER_SQL = """
+    INSERT INTO users (user_id, gender, premium, search_gender)
+    VALUES (:user_id, :gender, COALESCE(:premium, 0), COALESCE(:search_gender, :default_search_gender))
+    ON CONFLICT(user_id) DO UPDATE SET
+        gender = COALESCE(:gender, gender),
+        premium = COALESCE(:premium, premium),
+        search_gender = COALESCE(:search_gender, search_gender)
+"""
 
 
 def update_user_data(user_id, gender=None, premium=None, search_gender=None):
-    ensure_user_record(user_id)
-    updates = []
-    params = []
-    if gender is not None:
-        updates.append('gender = ?')
-        params.append(gender)
     if premium is not None:
-        updates.append('premium = ?')
-        params.append(int(bool(premium)))
-    if search_gender is not None:
-        updates.append('search_gender = ?')
-        params.append(search_gender)
-
-    if updates:
-        conn = sqlite3.connect(USER_DB_PATH)
-        cursor = conn.cursor()
-        params.append(user_id)
-        cursor.execute(f"UPDATE users SET {', '.join(updates)} WHERE user_id = ?", params)
-        conn.commit()
-        conn.close()
+        premium = bool(premium)
+    with get_user_conn() as conn:
+        conn.execute(_UPSERT_USER_SQL, {
+            "user_id": user_id,
+            "gender": gender,
+            "premium": None if premium is None else int(premium),
+            "search_gender": search_gender,
+            "default_search_gender": DEFAULT_SEARCH_GENDER,
+        })
 
-    refresh_user_cache(user_id)
+    cached = user_data.get(user_id)
+    if cached is None:
+        refresh_user_cache(user_id)
+        with _WAITING_LOCK:
+            _rebucket_waiting(user_id)
+        return
+    # Под блокировкой очереди: поиск не увидит запись, обновлённую наполовину,
+    # а ожидающий сразу переезжает в очередь по новому ключу
+    with _WAITING_LOCK:
+        if gender is not None:
+            cached.gender = gender
+        if premium is not None:
+            cached.premium = premium
+        if search_gender is not None:
+            cached.search_gender = search_gender
+        _rebucket_waiting(user_id)
 
 
 def set_user_gender(user_id, gender):
@@ -289,82 +405,141 @@ def set_search_gender(user_id, search_gender):
 def set_premium_status(user_id, is_premium):
     update_user_data(user_id, premium=bool(is_premium))
 
+def ban_many(user_ids, reason):
+    """Банит список пользователей одной транзакцией."""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    created_at = datetime.now().isoformat()
+    with get_user_conn() as conn:
+        with conn:
+            conn.executemany("UPDATE users SET banned = 1 WHERE user_id = ?", [(uid,) for uid in user_ids])
+            conn.executemany(
+                "INSERT OR REPLACE INTO bans (user_id, reason, created_at) VALUES (?, ?, ?)",
+                [(uid, reason, created_at) for uid in user_ids],
+            )
+    for uid in user_ids:
+        cached = user_data.get(uid)
+        if cached is not None:
+            cached.banned = True
+
+
+def unban_many(user_ids):
+    """Снимает бан со списка пользователей одной транзакцией."""
+    params = [(uid,) for uid in user_ids]
+    if not params:
+        return
+    with get_user_conn() as conn:
+        with conn:
+            conn.executemany("UPDATE users SET banned = 0 WHERE user_id = ?", params)
+            conn.executemany("DELETE FROM bans WHERE user_id = ?", params)
+    for (uid,) in params:
+        cached = user_data.get(uid)
+        if cached is not None:
+            cached.banned = False
+
+
 def ban_user(user_id, reason):
-    conn = sqlite3.connect(USER_DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE users SET banned = 1 WHERE user_id = ?", (user_id,))
-    cursor.execute("INSERT OR REPLACE INTO bans (user_id, reason, created_at) VALUES (?, ?, ?)",
-                   (user_id, reason, datetime.now().isoformat()))
-    conn.commit()
-    conn.close()
+    ban_many((user_id,), reason)
 
 def unban_user(user_id):
-    conn = sqlite3.connect(USER_DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE users SET banned = 0 WHERE user_id = ?", (user_id,))
-    cursor.execute("DELETE FROM bans WHERE user_id = ?", (user_id,))
-    conn.commit()
-    conn.close()
+    unban_many((user_id,))
+
+# Схема БД пользователей: DDL собирается один раз при импорте.
+# SQLite не принимает параметры (?) в DDL, поэтому DEFAULT экранируется здесь же.
+_SQL_SEARCH_GENDER_DEFAULT = "'" + DEFAULT_SEARCH_GENDER.replace("'", "''") + "'"
+_USER_COLUMNS = {
+    'gender': "TEXT",
+    'premium': "INTEGER DEFAULT 0",
+    'search_gender': f"TEXT DEFAULT {_SQL_SEARCH_GENDER_DEFAULT}",
+    'banned': "INTEGER DEFAULT 0",
+}
+_USERS_DDL = (
+    "CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, "
+    + ", ".join(f"{name} {ddl}" for name, ddl in _USER_COLUMNS.items())
+    + ")"
+)
+_BANS_DDL = '''CREATE TABLE IF NOT EXISTS bans (
+    user_id INTEGER PRIMARY KEY,
+    reason TEXT,
+    created_at TEXT
+)'''
 
-def is_banned(user_id):
-    conn = sqlite3.connect(USER_DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT banned FROM users WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    return result and result[0] == 1
 
 # Инициализация БД пользователей
 def _ensure_user_columns(cursor):
     cursor.execute("PRAGMA table_info(users)")
     existing = {row[1] for row in cursor.fetchall()}
+    if existing >= _USER_COLUMNS.keys():
+        return
 
-    safe_search_gender = DEFAULT_SEARCH_GENDER.replace("'", "''")
-    required_columns = {
-        'gender': "TEXT",
-        'premium': "INTEGER DEFAULT 0",
-        'search_gender': f"TEXT DEFAULT '{safe_search_gender}'",
-        'banned': "INTEGER DEFAULT 0",
-    }
-
-    for column_name, ddl in required_columns.items():
+    for column_name, ddl in _USER_COLUMNS.items():
         if column_name not in existing:
             cursor.execute(f"ALTER TABLE users ADD COLUMN {column_name} {ddl}")
 
 
 def init_user_db():
-    conn = sqlite3.connect(USER_DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(f'''CREATE TABLE IF NOT EXISTS users (
-        user_id INTEGER PRIMARY KEY,
-        gender TEXT,
-        premium INTEGER DEFAULT 0,
-        search_gender TEXT DEFAULT '{DEFAULT_SEARCH_GENDER}',
-        banned INTEGER DEFAULT 0
-    )''')
-    cursor.execute('''CREATE TABLE IF NOT EXISTS bans (
-        user_id INTEGER PRIMARY KEY,
-        reason TEXT,
-        created_at TEXT
-    )''')
-    _ensure_user_columns(cursor)
-    conn.commit()
-    conn.close()
+    with get_user_conn() as conn:
+        # journal_mode сохраняется в файле БД, достаточно выставить его один раз
+        conn.execute("PRAGMA journal_mode=WAL")
+        cursor = conn.cursor()
+        # Вся проверка схемы — одна транзакция: при актуальной схеме ничего не пишется
+        cursor.execute("BEGIN")
+        cursor.execute(_USERS_DDL)
+        cursor.execute(_BANS_DDL)
+        _ensure_user_columns(cursor)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_banned ON users(banned)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_premium ON users(premium) WHERE premium = 1")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_bans_created_at ON bans(created_at DESC)")
 
 # Инициализируем БД при запуске
 init_user_db()
 
+# Клавиатуры статичны (канал и цена известны при запуске), поэтому собираем их один раз
+_SUBSCRIPTION_MARKUP = InlineKeyboardMarkup()
+_SUBSCRIPTION_MARKUP.add(InlineKeyboardButton("Подписаться на канал", url=f"https://t.me/{CHANNEL_USERNAME}"))
+_SUBSCRIPTION_MARKUP.add(InlineKeyboardButton("Проверить подписку ✅", callback_data="check_subscription"))
+
+_GENDER_MARKUP = InlineKeyboardMarkup()
+_GENDER_MARKUP.add(
+    InlineKeyboardButton("Мальчик 👦", callback_data="gender_boy"),
+    InlineKeyboardButton("Девочка 👩", callback_data="gender_girl"),
+)
+
+_PREMIUM_SETTINGS_MARKUP = InlineKeyboardMarkup(row_width=1)
+_PREMIUM_SETTINGS_MARKUP.add(InlineKeyboardButton("Любой пол", callback_data="search_gender_any"))
+_PREMIUM_SETTINGS_MARKUP.add(InlineKeyboardButton("Искать мальчиков 👦", callback_data="search_gender_male"))
+_PREMIUM_SETTINGS_MARKUP.add(InlineKeyboardButton("Искать девочек 👩", callback_data="search_gender_female"))
+
+_PREMIUM_MENU_MARKUP = InlineKeyboardMarkup()
+_PREMIUM_MENU_MARKUP.add(InlineKeyboardButton("Премиум настройки", callback_data="premium_settings"))
+
+_BUY_PREMIUM_MARKUP = InlineKeyboardMarkup()
+_BUY_PREMIUM_MARKUP.add(InlineKeyboardButton(f"Перейти к оплате в CryptoBot - {VIP_PRICE}₽", callback_data="buy_premium"))
+
+_STOP_MARKUP = ReplyKeyboardMarkup(resize_keyboard=True)
+_STOP_MARKUP.add(KeyboardButton("❌ Остановить поиск собеседника"))
+
+
+def _build_main_markup(with_admin_button):
+    markup = ReplyKeyboardMarkup(resize_keyboard=True)
+    markup.add(KeyboardButton("Начать поиск 🔍"))
+    markup.add(KeyboardButton("Личный кабинет 👤"), KeyboardButton("Премиум поиск 👑"))
+    if with_admin_button:
+        markup.add(KeyboardButton("⚙️ Админка"))
+    return markup
+
+
+_MAIN_MARKUP_USER = _build_main_markup(False)
+_MAIN_MARKUP_ADMIN = _build_main_markup(True)
+
+
 # Отправка кнопок для подписки
 def send_subscription_buttons(chat_id):
     if not SUBSCRIPTION_REQUIRED:
         bot.send_message(chat_id, "Подписка на канал не требуется. Нажмите /start, чтобы продолжить.")
         return
-    markup = InlineKeyboardMarkup()
-    channel_button = InlineKeyboardButton("Подписаться на канал", url=f"https://t.me/{CHANNEL_USERNAME}")
-    check_button = InlineKeyboardButton("Проверить подписку ✅", callback_data="check_subscription")
-    markup.add(channel_button)
-    markup.add(check_button)
-    bot.send_message(chat_id, "Для использования бота необходимо подписаться на канал:", reply_markup=markup)
+    bot.send_message(chat_id, "Для использования бота необходимо подписаться на канал:", reply_markup=_SUBSCRIPTION_MARKUP)
 
 # Проверка подписки перед выполнением действий
 def is_user_subscribed(user_id):
@@ -377,148 +552,155 @@ def is_user_subscribed(user_id):
 
 # Спрашиваем пол пользователя
 def ask_gender(user_id):
-    markup = InlineKeyboardMarkup()
-    boy_button = InlineKeyboardButton("Мальчик 👦", callback_data="gender_boy")
-    girl_button = InlineKeyboardButton("Девочка 👩", callback_data="gender_girl")
-    markup.add(boy_button, girl_button)
-    bot.send_message(user_id, "Выберите ваш пол:", reply_markup=markup)
+    bot.send_message(user_id, "Выберите ваш пол:", reply_markup=_GENDER_MARKUP)
+
+# Callback обработчики для выбора пола, подписки и премиума
+def _cb_check_subscription(call, user_id):
+    # Пользователь явно просит перепроверить — не доверяем кэшу
+    _SUB_CACHE.pop(user_id, None)
+    if check_subscription(user_id):
+        bot.answer_callback_query(call.id, "Вы подписаны! Добро пожаловать 😊.")
+        bot.send_message(user_id, "Вы успешно подписались на канал!")
+        if not user_data[user_id].gender:
+            ask_gender(user_id)
+        else:
+            show_main_buttons(user_id)
+    else:
+        bot.answer_callback_query(call.id, "Вы не подписаны. Подпишитесь и попробуйте снова 😥.")
+        send_subscription_buttons(user_id)
 
-# Callback обработчик для выбора пола и подписки
-@bot.callback_query_handler(func=lambda call: True)
-def callback_query(call):
-    user_id = call.from_user.id
-    ensure_user_loaded(user_id)
 
-    admin_callbacks = {"broadcast", "ban_menu", "ban_add", "ban_remove", "ban_list", "admin_back", "stats"}
-    if call.data in admin_callbacks:
-        if handle_admin_callback(call):
-            return
+def _cb_gender(call, user_id, gender_label):
+    set_user_gender(user_id, gender_label)
+    icon = "👦" if gender_label == "Мальчик" else "👩"
+    bot.answer_callback_query(call.id, f"Вы выбрали: {gender_label} {icon}.")
+    bot.send_message(user_id, f"Ваш выбор сохранён: {gender_label} {icon}.")
+    show_main_buttons(user_id)
 
-    # Ответ на проверку подписки
-    if call.data == "check_subscription":
-        if check_subscription(user_id):
-            bot.answer_callback_query(call.id, "Вы подписаны! Добро пожаловать 😊.")
-            bot.send_message(user_id, "Вы успешно подписались на канал!")
-            if not user_data[user_id]["gender"]:
-                ask_gender(user_id)
-            else:
-                show_main_buttons(user_id)
-        else:
-            bot.answer_callback_query(call.id, "Вы не подписаны. Подпишитесь и попробуйте снова 😥.")
-            send_subscription_buttons(user_id)
-
-    # Ответ на выбор пола
-    elif call.data == "gender_boy":
-        set_user_gender(user_id, "Мальчик")
-        bot.answer_callback_query(call.id, "Вы выбрали: Мальчик 👦.")
-        bot.send_message(user_id, "Ваш выбор сохранён: Мальчик 👦.")
-        show_main_buttons(user_id)
 
-    elif call.data == "gender_girl":
-        set_user_gender(user_id, "Девочка")
-        bot.answer_callback_query(call.id, "Вы выбрали: Девочка 👩.")
-        bot.send_message(user_id, "Ваш выбор сохранён: Девочка 👩.")
-        show_main_buttons(user_id)
+def _cb_buy_premium(call, user_id):
+    bot.answer_callback_query(call.id)
+    create_invoice_for_premium(call.message)
 
-    elif call.data == "buy_premium":
-        bot.answer_callback_query(call.id)
-        create_invoice_for_premium(call.message)
 
-    elif call.data == "check_payment":
-        bot.answer_callback_query(call.id)
-        check_payment_status(call)
+def _cb_check_payment(call, user_id):
+    bot.answer_callback_query(call.id)
+    check_payment_status(call)
 
-    elif call.data == "premium_settings":
-        if user_data[user_id]["premium"]:
-            show_premium_settings(user_id)
-            bot.answer_callback_query(call.id)
-        else:
-            bot.answer_callback_query(call.id, "У вас нет премиум подписки.")
 
-    elif call.data in {"search_gender_any", "search_gender_male", "search_gender_female"}:
-        if not user_data[user_id]["premium"]:
-            bot.answer_callback_query(call.id, "Настройки доступны только премиум пользователям.")
-            return
-        mapping = {
-            "search_gender_any": DEFAULT_SEARCH_GENDER,
-            "search_gender_male": "Мальчик",
-            "search_gender_female": "Девочка"
-        }
-        target = mapping.get(call.data, DEFAULT_SEARCH_GENDER)
-        set_search_gender(user_id, target)
-        bot.answer_callback_query(call.id, f"Пол для поиска: {target}")
+def _cb_premium_settings(call, user_id):
+    if user_data[user_id].premium:
         show_premium_settings(user_id)
+        bot.answer_callback_query(call.id)
+    else:
+        bot.answer_callback_query(call.id, "У вас нет премиум подписки.")
+
+
+SEARCH_GENDER_CALLBACKS = {
+    "search_gender_any": DEFAULT_SEARCH_GENDER,
+    "search_gender_male": "Мальчик",
+    "search_gender_female": "Девочка",
+}
+
+
+def _cb_search_gender(call, user_id):
+    if not user_data[user_id].premium:
+        bot.answer_callback_query(call.id, "Настройки доступны только премиум пользователям.")
+        return
+    target = SEARCH_GENDER_CALLBACKS.get(call.data, DEFAULT_SEARCH_GENDER)
+    set_search_gender(user_id, target)
+    bot.answer_callback_query(call.id, f"Пол для поиска: {target}")
+    show_premium_settings(user_id)
+
+
+def _cb_admin(call, user_id):
+    handle_admin_callback(call)
+
+
+_CALLBACK_HANDLERS = {
+    "check_subscription": _cb_check_subscription,
+    "gender_boy": lambda call, user_id: _cb_gender(call, user_id, "Мальчик"),
+    "gender_girl": lambda call, user_id: _cb_gender(call, user_id, "Девочка"),
+    "buy_premium": _cb_buy_premium,
+    "check_payment": _cb_check_payment,
+    "premium_settings": _cb_premium_settings,
+}
+_CALLBACK_HANDLERS.update(dict.fromkeys(SEARCH_GENDER_CALLBACKS, _cb_search_gender))
+_CALLBACK_HANDLERS.update(dict.fromkeys(
+    ("broadcast", "ban_menu", "ban_add", "ban_remove", "ban_list", "admin_back", "stats"),
+    _cb_admin,
+))
+
+
+@bot.callback_query_handler(func=lambda call: True)
+def callback_query(call):
+    user_id = call.from_user.id
+    ensure_user_loaded(user_id)
+    handler = _CALLBACK_HANDLERS.get(call.data)
+    if handler:
+        handler(call, user_id)
 
 # Основные кнопки (Начать поиск)
-MENU_BUTTON_TEXTS = {
+MENU_BUTTON_TEXTS = frozenset({
     "Начать поиск 🔍",
     "Личный кабинет 👤",
     "Премиум поиск 👑",
     "⚙️ Админка",
     "❌ Остановить поиск собеседника",
-}
+})
+
+
+# Точные тексты, которые перехватывают отдельные хэндлеры
+_CONTROL_COMMANDS = MENU_BUTTON_TEXTS | {"/start", "/stop", "/next"}
 
 
 def is_control_command(text: str) -> bool:
     if not text:
         return False
+    # Кнопки меню обычно приходят без лишних пробелов — проверяем их до strip()
+    if text in MENU_BUTTON_TEXTS:
+        return True
     normalized = text.strip()
     if not normalized:
         return False
-    lowered = normalized.lower()
-    if normalized in MENU_BUTTON_TEXTS:
-        return True
-    if normalized.startswith("/"):
+    if normalized in MENU_BUTTON_TEXTS or normalized[0] == "/":
         return True
-    if lowered == "alluser":
-        return True
-    if lowered.startswith("rassilka"):
-        return True
-    return False
+    lowered = normalized.lower()
+    return lowered == "alluser" or lowered.startswith("rassilka")
 
 
 def _is_regular_incoming_message(message):
-    text = getattr(message, "text", None)
-    if text and is_control_command(text):
-        return False
-    return True
+    # Медиа (фото, стикеры, голосовые) не бывают командами — решаем без разбора текста
+    if message.content_type != 'text':
+        return True
+    return not is_control_command(message.text)
 
 
 def show_main_buttons(chat_id, prompt_text="Выберите действие:"):
-    markup = ReplyKeyboardMarkup(resize_keyboard=True)
-    search_button = KeyboardButton("Начать поиск 🔍")
-    profile_button = KeyboardButton("Личный кабинет 👤")
-    premium_button = KeyboardButton("Премиум поиск 👑")
-    markup.add(search_button)
-    markup.add(profile_button, premium_button)
-    if is_admin(chat_id):
-        markup.add(KeyboardButton("⚙️ Админка"))
+    markup = _MAIN_MARKUP_ADMIN if chat_id in ADMIN_IDS else _MAIN_MARKUP_USER
     bot.send_message(chat_id, prompt_text, reply_markup=markup)
 
+
+# Пул для независимых запросов к Telegram (уведомления собеседнику идут параллельно)
+_TG_IO = ThreadPoolExecutor(max_workers=8, thread_name_prefix="tg-io")
+
+
+def _notify_with_menu(chat_id, text):
+    # Внутри одного чата порядок сохраняется: сначала текст, затем меню
+    bot.send_message(chat_id, text)
+    show_main_buttons(chat_id)
+
 # Admin state handling
 @bot.message_handler(func=lambda m: m.from_user.id in user_states)
 def handle_admin_states(message):
     user_id = message.from_user.id
-    if not is_admin(user_id):
+    if user_id not in ADMIN_IDS:
         return
 
     state = user_states.get(user_id)
     if state == 'waiting_broadcast':
         # Send broadcast
-        conn = sqlite3.connect(USER_DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT user_id FROM users WHERE banned = 0")
-        users = cursor.fetchall()
-        conn.close()
-
-        success_count = 0
-        failure_count = 0
-        for user in users:
-            try:
-                bot.send_message(user[0], message.text)
-                success_count += 1
-            except:
-                failure_count += 1
+        success_count, failure_count = broadcast_text(iter_active_user_ids(), message.text)
 
         bot.send_message(user_id, f"✅ Рассылка завершена!\nУспешно: {success_count}\nОшибок: {failure_count}")
         del user_states[user_id]
@@ -546,27 +728,73 @@ def handle_admin_states(message):
             bot.send_message(user_id, "❌ Неверный ID.")
         del user_states[user_id]
 
-def send_bulk_message(message_text):
-    conn = sqlite3.connect(USER_DB_PATH)
-    cursor = conn.cursor()
+BROADCAST_WORKERS = 20
+BROADCAST_BATCH_SIZE = 25  # Telegram допускает ~30 сообщений в секунду
+USER_ID_PAGE_SIZE = 500
+
+
+def iter_active_user_ids(page_size=USER_ID_PAGE_SIZE):
+    """ID незабаненных пользователей порциями по возрастанию user_id.
+
+    Каждая порция — отдельный короткий запрос по первичному ключу: между порциями
+    соединение возвращается в пул и не держит снимок WAL на время долгой рассылки.
+    """
+    last_id = None
+    while True:
+        with get_user_conn() as conn:
+            if last_id is None:
+                cursor = conn.execute(
+                    "SELECT user_id FROM users WHERE banned = 0 ORDER BY user_id LIMIT ?",
+                    (page_size,)
+                )
+            else:
+                cursor = conn.execute(
+                    "SELECT user_id FROM users WHERE banned = 0 AND user_id > ? ORDER BY user_id LIMIT ?",
+                    (last_id, page_size)
+                )
+            ids = [uid for (uid,) in cursor]
+        yield from ids
+        if len(ids) < page_size:
+            return
+        last_id = ids[-1]
 
-    # Получаем все ID пользователей
-    cursor.execute('SELECT user_id FROM users')
-    users = cursor.fetchall()
 
+def broadcast_text(user_ids, message_text, log_errors=False):
+    """Рассылает текст пулом потоков, не превышая лимит Telegram; возвращает (успешно, ошибок).
+
+    Отправка идёт пачками: следующая пачка ставится только после того, как предыдущая
+    дошла и подсчитана, поэтому в памяти не больше BROADCAST_BATCH_SIZE futures.
+    """
     success_count = 0
     failure_count = 0
+    user_ids = iter(user_ids)
+    batch_started = None
+    with ThreadPoolExecutor(max_workers=BROADCAST_WORKERS) as executor:
+        while True:
+            batch = list(islice(user_ids, BROADCAST_BATCH_SIZE))
+            if not batch:
+                break
+            if batch_started is not None:
+                # Не больше одной пачки в секунду
+                pause = 1 - (time.monotonic() - batch_started)
+                if pause > 0:
+                    time.sleep(pause)
+            batch_started = time.monotonic()
+            futures = {executor.submit(bot.send_message, user_id, message_text): user_id for user_id in batch}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                    success_count += 1  # Успешная доставка
+                except Exception as e:
+                    failure_count += 1  # Неудачная доставка
+                    if log_errors:
+                        print(f"Не удалось отправить сообщение пользователю {futures[future]}: {str(e)}")
+    return success_count, failure_count
 
-    for user in users:
-        user_id = user[0]
-        try:
-            bot.send_message(user_id, message_text)
-            success_count += 1  # Успешная доставка
-        except Exception as e:
-            failure_count += 1  # Неудачная доставка
-            print(f"Не удалось отправить сообщение пользователю {user_id}: {str(e)}")
 
-    conn.close()
+def send_bulk_message(message_text):
+    # ID читаются порциями: отправка начинается сразу, список всех ID не собирается в памяти
+    success_count, failure_count = broadcast_text(iter_active_user_ids(), message_text, log_errors=True)
 
     # Возвращаем количество доставленных и недоставленных сообщений
     return success_count, failure_count
@@ -575,7 +803,7 @@ def send_bulk_message(message_text):
 @bot.message_handler(func=lambda message: bool(message.text and message.text.startswith("Rassilka")))
 def handle_rassilka(message):
     user_id = message.chat.id
-    if not is_admin(user_id):
+    if user_id not in ADMIN_IDS:
         bot.send_message(user_id, "У вас нет прав для отправки рассылки.")
         return
 
@@ -600,16 +828,10 @@ def premium_search(message):
     if not is_user_subscribed(user_id):
         return
 
-    if user_id in user_data and user_data[user_id]["premium"]:
-        markup = InlineKeyboardMarkup()
-        premium_settings_button = InlineKeyboardButton("Премиум настройки", callback_data="premium_settings")
-        markup.add(premium_settings_button)
-        bot.send_message(user_id, "У вас есть премиум подписка 🥳. Нажмите кнопку ниже, чтобы настроить поиск 🔍", reply_markup=markup)
+    if user_data.get(user_id, _NO_USER).premium:
+        bot.send_message(user_id, "У вас есть премиум подписка 🥳. Нажмите кнопку ниже, чтобы настроить поиск 🔍", reply_markup=_PREMIUM_MENU_MARKUP)
     else:
         # Если нет премиум подписки, показываем кнопку для перехода к оплате
-        markup = InlineKeyboardMarkup()
-        payment_button = InlineKeyboardButton(f"Перейти к оплате в CryptoBot - {VIP_PRICE}₽", callback_data="buy_premium")
-        markup.add(payment_button)
         bot.send_message(
             user_id,
             "🌟 *Откройте для себя эксклюзивные возможности с премиум-подпиской!* 🌟\n\n"
@@ -619,12 +841,23 @@ def premium_search(message):
             "⚡ *Приоритетный поиск* – Получайте собеседников быстрее остальных пользователей!\n"
             "💬 *Открытие новых возможностей* – Включите функции, которые делают общение более удобным и безопасным!\n\n"
             "💳 *Выберите способ оплаты ниже* и откройте доступ к уникальным возможностям!",
-            reply_markup=markup,
+            reply_markup=_BUY_PREMIUM_MARKUP,
             parse_mode='Markdown'
         )
 
         
 
+# Общая HTTPS-сессия Crypto Pay: соединение с pay.crypt.bot переиспользуется между запросами
+CRYPTO_PAY_API_URL = 'https://pay.crypt.bot/api'
+_CRYPTO_SESSION = requests.Session()
+_CRYPTO_SESSION.mount(
+    'https://',
+    HTTPAdapter(pool_connections=10, pool_maxsize=10, max_retries=Retry(total=3, backoff_factor=0.3)),
+)
+if CRYPTO_API_TOKEN:
+    _CRYPTO_SESSION.headers['Crypto-Pay-API-Token'] = CRYPTO_API_TOKEN
+
+
 # Функция для создания инвойса
 def create_invoice_for_premium(message):
     user_id = message.chat.id
@@ -642,12 +875,8 @@ def create_invoice_for_premium(message):
         'description': 'Оплата за премиум подписку',
     }
 
-    headers = {
-        'Crypto-Pay-API-Token': CRYPTO_API_TOKEN
-    }
-
     try:
-        response = requests.post('https://pay.crypt.bot/api/createInvoice', json=data, headers=headers)
+        response = _CRYPTO_SESSION.post(f'{CRYPTO_PAY_API_URL}/createInvoice', json=data)
 
         if response.status_code == 200:
             invoice_data = response.json()
@@ -655,7 +884,8 @@ def create_invoice_for_premium(message):
             invoice_id = invoice_data.get('result', {}).get('invoice_id', None)
 
             if invoice_url and invoice_id:
-                user_invoices[user_id] = {'invoice_id': invoice_id, 'amount': amount}
+                with _lk(user_id):
+                    user_invoices[user_id] = {'invoice_id': invoice_id, 'amount': amount}
 
                 markup = InlineKeyboardMarkup()
                 payment_button = InlineKeyboardButton(text="Перейти к оплате", url=invoice_url)
@@ -674,22 +904,30 @@ def create_invoice_for_premium(message):
 # Проверка статуса инвойса
 def check_payment_status(call):
     user_id = call.message.chat.id
-    invoice_id = user_invoices.get(user_id, {}).get('invoice_id')
+    # Поиск инвойса и кулдаун — под блокировкой пользователя, а время проверки резервируется
+    # до запроса: второе одновременное нажатие упрётся в кулдаун
+    with _lk(user_id):
+        invoice_id = user_invoices.get(user_id, {}).get('invoice_id')
+        cooling_down = False
+        if invoice_id:
+            current_time = time.monotonic()
+            last_checked = last_check_time.get(user_id)
+            cooling_down = last_checked is not None and current_time - last_checked < PAYMENT_CHECK_COOLDOWN
+            if not cooling_down:
+                last_check_time[user_id] = current_time
 
     if not invoice_id:
         bot.send_message(user_id, "Не удалось найти инвойс для проверки.")
         return
 
-    current_time = time.time()
-    if user_id in last_check_time and current_time - last_check_time[user_id] < 300:
+    if cooling_down:
         bot.send_message(user_id, "Пожалуйста, подождите 5 минут перед следующей проверкой статуса.")
         return
 
     params = {'invoice_ids': invoice_id}
-    headers = {'Crypto-Pay-API-Token': CRYPTO_API_TOKEN}
 
     try:
-        response = requests.get('https://pay.crypt.bot/api/getInvoices', headers=headers, params=params)
+        response = _CRYPTO_SESSION.get(f'{CRYPTO_PAY_API_URL}/getInvoices', params=params)
 
         if response.status_code == 200:
             invoice_data = response.json()
@@ -698,12 +936,15 @@ def check_payment_status(call):
             if invoices:
                 status = invoices[0].get('status')
                 if status == 'paid':
+                    # Активирует подписку только тот поток, который забрал инвойс
+                    with _lk(user_id):
+                        paid_invoice = user_invoices.pop(user_id, None)
+                    if paid_invoice is None:
+                        return
                     bot.send_message(user_id, "Оплата успешно выполнена! Подписка активирована.", parse_mode="HTML")
                     set_premium_status(user_id, True)
                     print(f"Премиум подписка активирована для пользователя {user_id}")
 
-                    # Удаляем инвойс после успешной оплаты
-                    del user_invoices[user_id]
                     # Показываем кнопку для премиум настроек
                     show_premium_settings(user_id)
                 elif status == 'expired':
@@ -718,61 +959,94 @@ def check_payment_status(call):
     except requests.exceptions.RequestException as e:
         bot.send_message(user_id, f'Ошибка при подключении к платежной системе: {str(e)}')
 
-    last_check_time[user_id] = current_time
-
 # Премиум настройки
 def show_premium_settings(user_id):
     ensure_user_loaded(user_id)
-    preference = user_data[user_id].get("search_gender") or DEFAULT_SEARCH_GENDER
-    markup = InlineKeyboardMarkup(row_width=1)
-    markup.add(InlineKeyboardButton("Любой пол", callback_data="search_gender_any"))
-    markup.add(InlineKeyboardButton("Искать мальчиков 👦", callback_data="search_gender_male"))
-    markup.add(InlineKeyboardButton("Искать девочек 👩", callback_data="search_gender_female"))
-    bot.send_message(user_id, f"Премиум настройки:\nТекущий выбор: {preference}", reply_markup=markup)
+    preference = user_data[user_id].search_gender
+    bot.send_message(user_id, f"Премиум настройки:\nТекущий выбор: {preference}", reply_markup=_PREMIUM_SETTINGS_MARKUP)
 
 # Поиск собеседников
 def show_stop_search_button(chat_id):
-    markup = ReplyKeyboardMarkup(resize_keyboard=True)
-    stop_button = KeyboardButton("❌ Остановить поиск собеседника")
-    markup.add(stop_button)
-    bot.send_message(chat_id, "Поиск собеседника... Нажмите кнопку, чтобы остановить поиск.", reply_markup=markup)
+    bot.send_message(chat_id, "Поиск собеседника... Нажмите кнопку, чтобы остановить поиск.", reply_markup=_STOP_MARKUP)
 
 
 def _user_preference(user_id):
-    data = user_data.get(user_id, {})
-    if data.get("premium"):
-        return data.get("search_gender") or DEFAULT_SEARCH_GENDER
+    data = user_data.get(user_id, _NO_USER)
+    if data.premium:
+        return data.search_gender
     return DEFAULT_SEARCH_GENDER
 
 
-def _user_gender(user_id):
-    return user_data.get(user_id, {}).get("gender")
+def _waiting_key(user_id):
+    return (user_data.get(user_id, _NO_USER).gender, _user_preference(user_id))
 
 
-def can_users_chat(user_a, user_b):
-    gender_a = _user_gender(user_a)
-    gender_b = _user_gender(user_b)
-    if gender_a is None or gender_b is None:
-        return False
+def _compatible_keys(gender, preference):
+    """Ключи очередей, из которых можно взять собеседника для (пол, искомый пол)."""
+    partner_genders = GENDER_CHOICES if preference == DEFAULT_SEARCH_GENDER else (preference,)
+    partner_preferences = (DEFAULT_SEARCH_GENDER, gender)
+    return [(g, p) for g in partner_genders for p in partner_preferences]
 
-    pref_a = _user_preference(user_a)
-    pref_b = _user_preference(user_b)
 
-    if pref_a != DEFAULT_SEARCH_GENDER and gender_b != pref_a:
-        return False
-    if pref_b != DEFAULT_SEARCH_GENDER and gender_a != pref_b:
-        return False
+def is_waiting(user_id):
+    return user_id in _user_bucket
+
+
+def waiting_count():
+    return len(_user_bucket)
+
+
+def add_to_waiting(user_id):
+    # Вызывается под _WAITING_LOCK
+    key = _waiting_key(user_id)
+    _waiting_by_key[key].append(user_id)
+    _user_bucket[user_id] = key
+
+
+def _discard_from_bucket(user_id, key):
+    # Вызывается под _WAITING_LOCK
+    bucket = _waiting_by_key[key]
+    bucket.remove(user_id)
+    if not bucket:
+        del _waiting_by_key[key]
+
+
+def _rebucket_waiting(user_id):
+    """Переносит ожидающего в очередь по текущим полу и искомому полу (под _WAITING_LOCK)."""
+    old_key = _user_bucket.get(user_id)
+    if old_key is None:
+        return
+    new_key = _waiting_key(user_id)
+    if new_key == old_key:
+        return
+    _discard_from_bucket(user_id, old_key)
+    _waiting_by_key[new_key].append(user_id)
+    _user_bucket[user_id] = new_key
+
+
+def remove_from_waiting(user_id):
+    with _WAITING_LOCK:
+        key = _user_bucket.pop(user_id, None)
+        if key is None:
+            return False
+        _discard_from_bucket(user_id, key)
     return True
 
 
 def find_partner_for_user(user_id):
-    if not waiting_users:
+    # Вызывается под _WAITING_LOCK
+    if not _user_bucket:
+        return None
+    gender, preference = _waiting_key(user_id)
+    if gender is None:
         return None
-    for partner_id in list(waiting_users):
-        if partner_id == user_id:
-            continue
-        if can_users_chat(user_id, partner_id):
-            waiting_users.remove(partner_id)
+    for key in _compatible_keys(gender, preference):
+        bucket = _waiting_by_key.get(key)
+        if bucket:
+            partner_id = bucket.popleft()
+            if not bucket:
+                del _waiting_by_key[key]
+            del _user_bucket[partner_id]
             return partner_id
     return None
 
@@ -789,28 +1063,47 @@ def send_chat_controls(chat_id):
 
 
 def connect_users(user_id, partner_id):
-    chat_partners[user_id] = partner_id
-    chat_partners[partner_id] = user_id
+    with _locked_pair(user_id, partner_id):
+        chat_partners[user_id] = partner_id
+        chat_partners[partner_id] = user_id
     send_chat_controls(user_id)
     send_chat_controls(partner_id)
 
 
 def begin_search_for_user(user_id):
     ensure_user_loaded(user_id)
-    if user_id in waiting_users:
+    if is_waiting(user_id):
         bot.send_message(user_id, "Вы уже в очереди. Ожидайте собеседника.")
         return
 
     bot.send_message(user_id, "Поиск начат. Кнопки больше не доступны.", reply_markup=ReplyKeyboardRemove())
     show_stop_search_button(user_id)
 
-    partner_id = find_partner_for_user(user_id)
+    # Поиск и постановка в очередь атомарны: два одновременных запроса не разминутся
+    with _WAITING_LOCK:
+        if is_waiting(user_id):
+            return
+        partner_id = find_partner_for_user(user_id)
+        if not partner_id:
+            add_to_waiting(user_id)
     if partner_id:
         connect_users(user_id, partner_id)
     else:
-        waiting_users.add(user_id)
         bot.send_message(user_id, "Вы добавлены в очередь. Ожидайте собеседника.")
 
+
+def disconnect_user(user_id):
+    """Разрывает пару пользователя и возвращает ID бывшего собеседника (или None)."""
+    partner_id = _cp_get(user_id)
+    if partner_id is None:
+        return None
+    with _locked_pair(user_id, partner_id):
+        if _cp_get(user_id) != partner_id:
+            return None
+        _cp_pop(user_id, None)
+        _cp_pop(partner_id, None)
+    return partner_id
+
 @bot.message_handler(func=lambda message: message.text == "Начать поиск 🔍")
 def start_search(message):
     user_id = message.chat.id
@@ -818,7 +1111,7 @@ def start_search(message):
     if not is_user_subscribed(user_id):
         return
 
-    if not user_data[user_id]["gender"]:
+    if not user_data[user_id].gender:
         ask_gender(user_id)
         return
 
@@ -828,8 +1121,7 @@ def start_search(message):
 @bot.message_handler(func=lambda message: message.text == "❌ Остановить поиск собеседника")
 def stop_search(message):
     user_id = message.chat.id
-    if user_id in waiting_users:
-        waiting_users.remove(user_id)
+    if remove_from_waiting(user_id):
         bot.send_message(user_id, "Поиск собеседника остановлен 🥲.")
     else:
         bot.send_message(user_id, "Вы не в поиске🤚.")
@@ -839,29 +1131,23 @@ def stop_search(message):
 @bot.message_handler(func=lambda message: bool(message.text) and message.text.lower() == "alluser")
 def handle_alluser(message):
     user_id = message.chat.id
-    if not is_admin(user_id):
+    if user_id not in ADMIN_IDS:
         bot.send_message(user_id, "У вас нет прав для получения этой информации.")
         return
 
-    conn = sqlite3.connect(USER_DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('SELECT COUNT(*) FROM users')
-    user_count = cursor.fetchone()[0]
-    conn.close()
+    with get_user_conn() as conn:
+        user_count = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
     bot.send_message(user_id, f"Количество пользователей, запустивших бота: {user_count}")
 
 # Разрыв связи при команде "/stop"
 @bot.message_handler(func=lambda message: message.text == "/stop")
 def stop_chat(message):
     user_id = message.chat.id
-    if user_id in chat_partners:
-        partner_id = chat_partners[user_id]
-        bot.send_message(user_id, "Вы разорвали связь.")
-        bot.send_message(partner_id, "Собеседник разорвал с вами связь😔.")
-        del chat_partners[user_id]
-        del chat_partners[partner_id]
-        show_main_buttons(user_id)
-        show_main_buttons(partner_id)
+    partner_id = disconnect_user(user_id)
+    if partner_id is not None:
+        partner_job = _TG_IO.submit(_notify_with_menu, partner_id, "Собеседник разорвал с вами связь😔.")
+        _notify_with_menu(user_id, "Вы разорвали связь.")
+        partner_job.result()
     else:
         bot.send_message(user_id, "У вас нет активного диалога. Используйте 'Начать поиск 🔍'.")
         show_main_buttons(user_id)
@@ -870,23 +1156,31 @@ def stop_chat(message):
 def next_chat(message):
     user_id = message.chat.id
     ensure_user_loaded(user_id)
-    if user_id not in chat_partners:
+    partner_id = disconnect_user(user_id)
+    if partner_id is None:
         bot.send_message(user_id, "У вас нет активного диалога. Используйте 'Начать поиск 🔍'.")
         return
 
-    partner_id = chat_partners[user_id]
+    partner_job = _TG_IO.submit(
+        _notify_with_menu, partner_id, "Собеседник завершил диалог и начал новый поиск 🔍."
+    )
     bot.send_message(user_id, "Ищем нового собеседника... 🔍")
-    bot.send_message(partner_id, "Собеседник завершил диалог и начал новый поиск 🔍.")
 
-    del chat_partners[user_id]
-    del chat_partners[partner_id]
-    show_main_buttons(partner_id)
-
-    if not user_data.get(user_id, {}).get("gender"):
+    if not user_data.get(user_id, _NO_USER).gender:
         ask_gender(user_id)
-        return
+    else:
+        begin_search_for_user(user_id)
+    partner_job.result()
+
+# Шаблон личного кабинета разбирается один раз; на каждый показ — только подстановка
+_render_profile = (
+    "👤 <b>Личный кабинет</b>\n\n"
+    "📛 <b>Username:</b> {username}\n"
+    "💎 <b>Премиум подписка:</b> {premium}\n"
+    "🚻 <b>Пол:</b> {gender}\n\n"
+    "🔒 Анонимность: <b>всегда</b>"
+).format_map
 
-    begin_search_for_user(user_id)
 
 @bot.message_handler(func=lambda message: message.text == "Личный кабинет 👤")
 def user_profile(message):
@@ -895,21 +1189,17 @@ def user_profile(message):
     if not is_user_subscribed(user_id):
         return
 
-    if user_id in user_data:
+    user_info = user_data.get(user_id)
+    if user_info is not None:
         tg_username = message.from_user.username
-        username_display = f"@{tg_username}" if tg_username else "Не указан"
-        gender_value = user_data[user_id].get("gender")
-        gender = gender_value or "Не выбран"
-        premium_status = "Да" if user_data[user_id]["premium"] else "Нет"
-        
+        gender_value = user_info.gender
+
         # Формируем сообщение с информацией о пользователе
-        profile_message = (
-            f"👤 <b>Личный кабинет</b>\n\n"
-            f"📛 <b>Username:</b> {username_display}\n"
-            f"💎 <b>Премиум подписка:</b> {premium_status}\n"
-            f"🚻 <b>Пол:</b> {gender}\n\n"
-            f"🔒 Анонимность: <b>всегда</b>"
-        )
+        profile_message = _render_profile({
+            "username": f"@{tg_username}" if tg_username else "Не указан",
+            "premium": "Да" if user_info.premium else "Нет",
+            "gender": gender_value or "Не выбран",
+        })
         bot.send_message(user_id, profile_message, parse_mode="HTML")
         if not gender_value:
             bot.send_message(user_id, "Пожалуйста, выберите пол для корректного подбора собеседников.")
@@ -919,11 +1209,8 @@ def user_profile(message):
         ask_gender(user_id)  # Попросим выбрать пол, если этого ещё не сделали.
 
 # Обработка сообщений (пересылка)
-@bot.message_handler(
-    func=_is_regular_incoming_message,
-    content_types=['text', 'photo', 'video', 'audio', 'voice', 'document', 'sticker']
-)
-def forward_message(message):
+def _forward_slow(message):
+    """Сообщение вне диалога (или от админа в процессе действия)."""
     user_id = message.chat.id
     ensure_user_loaded(user_id)
     if not is_user_subscribed(user_id):
@@ -933,70 +1220,101 @@ def forward_message(message):
         # Админ выполняет действие, не мешаем обработчикам состояний
         return
 
-    message_text = (message.text or "").strip()
-    if message_text and is_control_command(message_text):
+    show_main_buttons(user_id, "У вас сейчас нет собеседника. Нажмите 'Начать поиск 🔍', чтобы найти.")
+
+
+# Текст — самый частый случай, для него отдельный хэндлер
+@bot.message_handler(func=_is_regular_incoming_message, content_types=['text'])
+def forward_text(message):
+    user_id = message.chat.id
+
+    # Полная проверка is_control_command уже выполнена фильтром хэндлера;
+    # здесь остаётся дешёвая страховка без strip()
+    text = message.text
+    if not text or text in _CONTROL_COMMANDS or text[0] == '/':
         # Команда уже будет обработана соответствующим хэндлером
         return
 
-    if user_id in chat_partners:
-        partner_id = chat_partners[user_id]
+    # Быстрый путь: пользователь уже в диалоге (подписка проверена при входе в поиск)
+    partner_id = _cp_get(user_id)
+    if partner_id is not None and user_id not in user_states:
+        # Отправляем текст от имени бота (анонимно); entities сохраняют форматирование
+        bot.send_message(partner_id, text, entities=message.entities)
+        return
 
+    _forward_slow(message)
+
+
+# Медиа не бывают командами, поэтому фильтр текста здесь не нужен
+@bot.message_handler(content_types=['photo', 'video', 'audio', 'voice', 'document', 'sticker'])
+def forward_media(message):
+    user_id = message.chat.id
+    partner_id = _cp_get(user_id)
+    if partner_id is not None and user_id not in user_states:
         # Пересылаем сообщение собеседнику (анонимно, без показа username)
         bot.copy_message(partner_id, user_id, message.message_id)
-    else:
-        show_main_buttons(user_id, "У вас сейчас нет собеседника. Нажмите 'Начать поиск 🔍', чтобы найти.")
+        return
+
+    _forward_slow(message)
 
 # Функция для загрузки данных пользователя из базы данных в user_data
 def load_user_data():
-    conn = sqlite3.connect(USER_DB_PATH)
+    # Отдельное read-only соединение: массовое чтение при старте не держит соединения пула
+    conn = sqlite3.connect(f"file:{USER_DB_PATH}?mode=ro", uri=True)
     cursor = conn.cursor()
 
-    # Получаем все данные из базы
-    cursor.execute('SELECT user_id, gender, premium, search_gender FROM users')
-    users = cursor.fetchall()  # Получаем всех пользователей
-
-    for user in users:
-        user_id, gender, premium, search_gender = user
-        user_data[user_id] = {
-            "gender": gender,
-            "premium": bool(premium),
-            "search_gender": search_gender or DEFAULT_SEARCH_GENDER
-        }
+    # Читаем пользователей потоком: строки не копятся в промежуточном списке
+    rows = cursor.execute('SELECT user_id, gender, premium, search_gender, banned FROM users')
+    for user_id, gender, premium, search_gender, banned in rows:
+        user_data[user_id] = UserRec(gender, premium, search_gender, banned)
 
     conn.close()
 
 def send_creator_branding_banner(chat_id):
+    if not CREATOR_BRANDING_TEXT:
+        return
     ensure_user_loaded(chat_id)
-    user_info = user_data.get(chat_id, {})
-    if user_info.get("premium"):
+    if user_data.get(chat_id, _NO_USER).premium:
         return
-    text = _build_creator_branding_text()
-    if text:
-        bot.send_message(chat_id, text)
+    bot.send_message(chat_id, CREATOR_BRANDING_TEXT)
 
 # Admin functions
-def is_admin(user_id):
-    return user_id in ADMIN_IDS
+ADMIN_MENU_MARKUP = InlineKeyboardMarkup(row_width=1)
+ADMIN_MENU_MARKUP.add(InlineKeyboardButton("📣 Рассылка", callback_data="broadcast"))
+ADMIN_MENU_MARKUP.add(InlineKeyboardButton("🚫 Бан/Разбан", callback_data="ban_menu"))
+ADMIN_MENU_MARKUP.add(InlineKeyboardButton("📊 Статистика", callback_data="stats"))
+
+BAN_MENU_MARKUP = InlineKeyboardMarkup(row_width=1)
+BAN_MENU_MARKUP.add(InlineKeyboardButton("➕ Забанить", callback_data="ban_add"))
+BAN_MENU_MARKUP.add(InlineKeyboardButton("♻️ Разбанить", callback_data="ban_remove"))
+BAN_MENU_MARKUP.add(InlineKeyboardButton("📋 Список банов", callback_data="ban_list"))
+BAN_MENU_MARKUP.add(InlineKeyboardButton("⬅️ Назад", callback_data="admin_back"))
 
 def admin_menu():
-    markup = InlineKeyboardMarkup(row_width=1)
-    markup.add(InlineKeyboardButton("📣 Рассылка", callback_data="broadcast"))
-    markup.add(InlineKeyboardButton("🚫 Бан/Разбан", callback_data="ban_menu"))
-    markup.add(InlineKeyboardButton("📊 Статистика", callback_data="stats"))
-    return markup
+    return ADMIN_MENU_MARKUP
 
 def ban_menu():
-    markup = InlineKeyboardMarkup(row_width=1)
-    markup.add(InlineKeyboardButton("➕ Забанить", callback_data="ban_add"))
-    markup.add(InlineKeyboardButton("♻️ Разбанить", callback_data="ban_remove"))
-    markup.add(InlineKeyboardButton("📋 Список банов", callback_data="ban_list"))
-    markup.add(InlineKeyboardButton("⬅️ Назад", callback_data="admin_back"))
-    return markup
+    return BAN_MENU_MARKUP
+
+
+BAN_LIST_LIMIT = 20
+
+
+@lru_cache(maxsize=512)
+def _cached_escape(value):
+    return escape(value)
+
+
+def escape_short(value):
+    """HTML-экранирование с кэшем для коротких повторяющихся строк (причины банов, даты)."""
+    if len(value) < 64:
+        return _cached_escape(value)
+    return escape(value)
 
 
 def handle_admin_callback(call):
     user_id = call.from_user.id
-    if not is_admin(user_id):
+    if user_id not in ADMIN_IDS:
         bot.answer_callback_query(call.id, "Нет доступа", show_alert=True)
         return True
     data = call.data
@@ -1038,38 +1356,33 @@ def handle_admin_callback(call):
         return True
 
     if data == "ban_list":
-        conn = sqlite3.connect(USER_DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT user_id, reason, created_at FROM bans ORDER BY created_at DESC LIMIT 20"
-        )
-        rows = cursor.fetchall()
-        conn.close()
+        # Записи из bans удаляются при разбане, поэтому все строки — активные баны
+        with get_user_conn() as conn:
+            rows = conn.execute(
+                "SELECT user_id, reason, created_at FROM bans ORDER BY created_at DESC LIMIT ?",
+                (BAN_LIST_LIMIT,),
+            ).fetchall()
         if not rows:
             text = "🚫 Список банов пуст."
         else:
-            lines = ["🚫 Активные баны:", ""]
-            for banned_id, reason, created_at in rows:
-                reason_text = escape(reason or "Без причины")
-                timestamp = escape(created_at or "")
-                lines.append(f"<b>{banned_id}</b> — {reason_text}")
-                if timestamp:
-                    lines.append(f"└ {timestamp}")
+            text = "\n".join(["🚫 Активные баны:", ""] + [
+                f"<b>{banned_id}</b> — {escape_short(reason or 'Без причины')}"
+                + (f"\n└ {escape_short(created_at)}" if created_at else "")
+                for banned_id, reason, created_at in rows
+            ])
         bot.answer_callback_query(call.id)
-        bot.send_message(user_id, "\n".join(lines) if rows else text, parse_mode="HTML")
+        bot.send_message(user_id, text, parse_mode="HTML")
         return True
 
     if data == "stats":
-        conn = sqlite3.connect(USER_DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM users")
-        total_users = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM users WHERE premium = 1")
-        premium_users = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM users WHERE banned = 1")
-        banned_users = cursor.fetchone()[0]
-        conn.close()
-        waiting = len(waiting_users)
+        with get_user_conn() as conn:
+            total_users, premium_users, banned_users = conn.execute(
+                "SELECT COUNT(*), "
+                "COALESCE(SUM(CASE WHEN premium = 1 THEN 1 ELSE 0 END), 0), "
+                "COALESCE(SUM(CASE WHEN banned = 1 THEN 1 ELSE 0 END), 0) "
+                "FROM users"
+            ).fetchone()
+        waiting = waiting_count()
         active_pairs = len(chat_partners) // 2
         stats_text = (
             "📊 Статистика бота:\n"
@@ -1094,7 +1407,8 @@ def handle_admin_callback(call):
 def start(message):
     user_id = message.chat.id
     ensure_user_loaded(user_id)
-    if is_banned(user_id):
+    user_info = user_data[user_id]
+    if user_info.banned:
         bot.send_message(user_id, "🚫 Вы заблокированы.")
         return
     if not is_user_subscribed(user_id):
@@ -1103,14 +1417,14 @@ def start(message):
     send_creator_branding_banner(user_id)
     bot.send_message(user_id, WELCOME_MESSAGE)
 
-    if not user_data[user_id]["gender"]:
+    if not user_info.gender:
         ask_gender(user_id)
     show_main_buttons(user_id)
 
 # Admin panel handler
 @bot.message_handler(func=lambda message: message.text == "⚙️ Админка")
 def admin_panel(message):
-    if not is_admin(message.from_user.id):
+    if message.from_user.id not in ADMIN_IDS:
         return
     bot.send_message(message.chat.id, "⚙️ Админ панель:", reply_markup=admin_menu())
 
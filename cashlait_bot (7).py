@@ -13,25 +13,41 @@ Features implemented:
 
 from __future__ import annotations
 
+import functools
+import heapq
+import itertools
 import json
 import logging
 import os
+import queue
+import re
 import sqlite3
 import sys
 import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from dataclasses import dataclass
 from datetime import UTC, datetime, timedelta
 from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 from html import escape
 from io import BytesIO
-from typing import Any, Dict, Iterable, List, Optional, Tuple
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
 
 import requests
 import telebot
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from telebot import types
 from telebot.apihelper import ApiException
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 DEFAULT_CONSTRUCTOR_USERNAME = "MinxoCreate_bot"
 DEFAULT_CREATOR_BRANDING_LINK = f"https://t.me/{DEFAULT_CONSTRUCTOR_USERNAME}"
@@ -40,8 +56,8 @@ CREATOR_DB_PATH = os.getenv(
     os.path.join(os.path.dirname(__file__), "creator_data2.db"),
 )
 
-_BOOLEAN_TRUE_VALUES = {"1", "true", "yes", "on", "enable", "enabled", "y"}
-_BOOLEAN_FALSE_VALUES = {"0", "false", "no", "off", "disable", "disabled", "n"}
+_BOOLEAN_TRUE_VALUES = frozenset({"1", "true", "yes", "on", "enable", "enabled", "y"})
+_BOOLEAN_FALSE_VALUES = frozenset({"0", "false", "no", "off", "disable", "disabled", "n"})
 
 
 def _clean_text(value: Any) -> str:
@@ -50,24 +66,33 @@ def _clean_text(value: Any) -> str:
     return str(value).strip()
 
 
-def _bool_from_raw(value: Any) -> Optional[bool]:
-    if isinstance(value, bool):
-        return value
-    text = _clean_text(value).lower()
-    if not text:
+# Глобальные значения привязаны как аргументы по умолчанию: внутри функций это быстрые локальные имена.
+def _bool_from_raw(
+    value: Any,
+    _true: frozenset = _BOOLEAN_TRUE_VALUES,
+    _false: frozenset = _BOOLEAN_FALSE_VALUES,
+) -> Optional[bool]:
+    if value is None:
         return None
-    if text in _BOOLEAN_TRUE_VALUES:
+    if value is True or value is False:
+        return value
+    text = str(value).strip().lower()
+    if text == "true" or text == "1":
+        return True
+    if text == "false" or text == "0":
+        return False
+    if text in _true:
         return True
-    if text in _BOOLEAN_FALSE_VALUES:
+    if text in _false:
         return False
     return None
 
 
-def _safe_int(value: Any) -> Optional[int]:
+def _safe_int(value: Any, _int: type = int, _str: type = str) -> Optional[int]:
     if value is None:
         return None
     try:
-        return int(str(value).strip())
+        return _int(_str(value).strip())
     except (TypeError, ValueError):
         return None
 
@@ -86,50 +111,62 @@ def _detect_creator_bot_id() -> Optional[int]:
     return None
 
 
+_CREATOR_CONN: Optional[sqlite3.Connection] = None
+_CREATOR_CONN_LOCK = threading.Lock()
+
+
+def _creator_conn() -> Optional[sqlite3.Connection]:
+    """Единственное read-only соединение с БД конструктора (открывается при первом обращении)."""
+    global _CREATOR_CONN
+    if _CREATOR_CONN is None:
+        if not CREATOR_DB_PATH or not os.path.exists(CREATOR_DB_PATH):
+            return None
+        uri = Path(CREATOR_DB_PATH).resolve().as_uri() + "?mode=ro"
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        _CREATOR_CONN = conn
+    return _CREATOR_CONN
+
+
 def _load_creator_settings(keys: Iterable[str]) -> Dict[str, str]:
     unique_keys = [key for key in dict.fromkeys(keys) if key]
-    if not unique_keys or not CREATOR_DB_PATH or not os.path.exists(CREATOR_DB_PATH):
+    if not unique_keys:
         return {}
-    conn: Optional[sqlite3.Connection] = None
+    placeholders = ", ".join("?" for _ in unique_keys)
     try:
-        conn = sqlite3.connect(CREATOR_DB_PATH)
-        conn.row_factory = sqlite3.Row
-        placeholders = ", ".join("?" for _ in unique_keys)
-        cur = conn.execute(
-            f"SELECT key, value FROM settings WHERE key IN ({placeholders})",
-            tuple(unique_keys),
-        )
-        result: Dict[str, str] = {}
-        for row in cur.fetchall():
-            key = row["key"]
-            value = _clean_text(row["value"])
-            if key and value:
-                result[str(key)] = value
-        return result
+        with _CREATOR_CONN_LOCK:
+            conn = _creator_conn()
+            if conn is None:
+                return {}
+            rows = conn.execute(
+                f"SELECT key, value FROM settings WHERE key IN ({placeholders})",
+                tuple(unique_keys),
+            ).fetchall()
     except sqlite3.Error:
         return {}
-    finally:
-        if conn:
-            conn.close()
+    result: Dict[str, str] = {}
+    for row in rows:
+        key = row["key"]
+        value = _clean_text(row["value"])
+        if key and value:
+            result[str(key)] = value
+    return result
 
 
 def _load_creator_bot_meta(bot_id: Optional[int]) -> Dict[str, Any]:
-    if not bot_id or not CREATOR_DB_PATH or not os.path.exists(CREATOR_DB_PATH):
+    if not bot_id:
         return {}
-    conn: Optional[sqlite3.Connection] = None
     try:
-        conn = sqlite3.connect(CREATOR_DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cur = conn.execute("SELECT vip_status FROM bots WHERE id = ?", (bot_id,))
-        row = cur.fetchone()
-        if not row:
-            return {}
-        return dict(row)
+        with _CREATOR_CONN_LOCK:
+            conn = _creator_conn()
+            if conn is None:
+                return {}
+            row = conn.execute("SELECT vip_status FROM bots WHERE id = ?", (bot_id,)).fetchone()
     except sqlite3.Error:
         return {}
-    finally:
-        if conn:
-            conn.close()
+    if not row:
+        return {}
+    return dict(row)
 
 
 CREATOR_BOT_ID = _detect_creator_bot_id()
@@ -149,41 +186,31 @@ CREATOR_BOT_META = _load_creator_bot_meta(CREATOR_BOT_ID)
 _CREATOR_VIP_STATUS_RAW = CREATOR_BOT_META.get("vip_status")
 
 
+_TELEGRAM_LINK_RE = re.compile(r"^(?:https?://)?(?:t|telegram)\.me/([^/?]*)", re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=32)
 def _extract_username_from_link(value: Optional[str]) -> str:
     """Возвращает @username, если в ссылке или строке содержится Telegram-юзер."""
     if not value:
         return ""
-    trimmed = str(value).strip()
+    trimmed = str(value).strip().rstrip("/")
     if not trimmed:
         return ""
-    trimmed = trimmed.rstrip("/")
-    lower_value = trimmed.lower()
-    prefixes = (
-        "https://t.me/",
-        "http://t.me/",
-        "https://telegram.me/",
-        "http://telegram.me/",
-        "t.me/",
-        "telegram.me/",
-    )
-    username = ""
-    for prefix in prefixes:
-        if lower_value.startswith(prefix):
-            username = trimmed[len(prefix):]
-            break
+    match = _TELEGRAM_LINK_RE.match(trimmed)
+    if match:
+        username = match.group(1)
+    elif trimmed.startswith("@"):
+        username = trimmed.lstrip("@").split("/", 1)[0].split("?", 1)[0]
     else:
-        if trimmed.startswith("@"):
-            username = trimmed.lstrip("@")
-        else:
-            return ""
-    username = username.split("/", 1)[0]
-    username = username.split("?", 1)[0]
+        return ""
     username = username.strip().lstrip("@")
     if not username:
         return ""
     return f"@{username}"
 
 
+@functools.lru_cache(maxsize=32)
 def _build_creator_link(candidate: Optional[str], fallback_username: str) -> str:
     """Превращает произвольную строку/юзер в https://t.me/ ссылку."""
     candidate_clean = (candidate or "").strip()
@@ -245,11 +272,12 @@ LEGACY_CREATOR_LABELS = {
     "🤖 Хочу такого же бота",
     "Хочу такого же бота",
 }
-ADMIN_IDS = {
+_ADMIN_IDS_SEPARATOR_RE = re.compile(r"[,;]+")
+ADMIN_IDS = frozenset(
     int(token)
-    for token in os.getenv("ADMIN_IDS", "6745031200,8395830207").replace(";", ",").split(",")
+    for token in _ADMIN_IDS_SEPARATOR_RE.split(os.getenv("ADMIN_IDS", "6745031200,8395830207"))
     if token.strip().isdigit()
-}
+)
 DATABASE_PATH = os.getenv(
     "CASHLAIT_DB",
     os.path.join(os.path.dirname(__file__), "cashlait.db"),
@@ -349,22 +377,78 @@ MONEY_QUANT = Decimal("0.001")
 ASSET_QUANT = Decimal("0.00000001")
 FLYER_FAIL_STATUSES = {"incomplete", "abort"}
 FLYER_PENALTY_STATUSES = {"unsubscribe", "unsubscribed", "left", "removed", "abort"}
+# Все штрафные подстроки ищутся одним проходом по статусу
+_FLYER_PENALTY_RE = re.compile("|".join(map(re.escape, sorted(FLYER_PENALTY_STATUSES))))
 DECIMAL_INPUT_QUANT = Decimal("0.0001")
 
 
+# Агрегаты по деньгам считаются в целых единицах 1e-8: SUM по INTEGER точен и не копит ошибку float
+MONEY_SCALE_DIGITS = 8
+
+
+def _money_units_sum_sql(expr: str) -> str:
+    return f"COALESCE(SUM(CAST(ROUND(({expr}) * 1e{MONEY_SCALE_DIGITS}) AS INTEGER)), 0)"
+
+
+def _money_from_units(units: Any) -> Decimal:
+    return Decimal(int(units or 0)).scaleb(-MONEY_SCALE_DIGITS)
+
+
+def _money_to_units(value: Any) -> int:
+    return int(dec(value).scaleb(MONEY_SCALE_DIGITS).to_integral_value(rounding=ROUND_HALF_UP))
+
+
+# Payload заданий в pending_tasks и тела HTTP-запросов: orjson, если установлен, иначе стандартный json
+if orjson is not None:
+    def _dump_payload(data: Dict[str, Any]) -> str:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def _dump_json_body(data: Dict[str, Any]) -> bytes:
+        return orjson.dumps(data)
+
+    _load_payload = orjson.loads
+else:
+    def _dump_payload(data: Dict[str, Any]) -> str:
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+    def _dump_json_body(data: Dict[str, Any]) -> bytes:
+        return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+    _load_payload = json.loads
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+
 def now_utc() -> datetime:
     return datetime.now(UTC)
 
 
-def dec(value: Any, default: str = "0") -> Decimal:
+AMOUNT_DISPLAY_QUANT = Decimal("0.000")
+
+
+def dec(
+    value: Any,
+    default: str = "0",
+    _dec: type = Decimal,
+    _str: type = str,
+    _invalid: type = InvalidOperation,
+) -> Decimal:
+    # Decimal неизменяем — готовое значение возвращаем как есть
+    value_type = type(value)
+    if value_type is _dec:
+        return value
+    # int и str разбираются напрямую, без промежуточного str();
+    # float по-прежнему идёт через str(), чтобы не тянуть двоичный хвост
+    if value_type is int:
+        return _dec(value)
     try:
-        return Decimal(str(value))
-    except (InvalidOperation, TypeError):
-        return Decimal(default)
+        return _dec(value if value_type is _str else _str(value))
+    except (_invalid, TypeError):
+        return _dec(default)
 
 
 def format_amount(amount: Decimal, symbol: str) -> str:
-    return f"{amount.quantize(Decimal('0.000'), rounding=ROUND_HALF_UP)} {symbol}"
+    return f"{amount.quantize(AMOUNT_DISPLAY_QUANT, rounding=ROUND_HALF_UP)} {symbol}"
 
 
 def format_duration(delta: timedelta) -> str:
@@ -397,10 +481,12 @@ def parse_chat_identifier(value: str) -> Optional[int | str]:
 
 def row_get(row: Any, key: str, default: Any = None) -> Any:
     if isinstance(row, sqlite3.Row):
-        if key in row.keys():
+        # Прямое обращение по имени без построения списка keys() на каждый вызов
+        try:
             value = row[key]
-            return default if value is None else value
-        return default
+        except IndexError:
+            return default
+        return default if value is None else value
     if isinstance(row, dict):
         return row.get(key, default)
     return getattr(row, key, default)
@@ -416,6 +502,7 @@ def row_to_dict(row: Any) -> Dict[str, Any]:
     return {"value": row}
 
 
+@functools.lru_cache(maxsize=128)
 def mask_setting_value(value: str) -> str:
     if not value:
         return "не задано"
@@ -481,15 +568,22 @@ def _creator_label_html(label: str, normalized_link: str) -> str:
     return safe_label or safe_link
 
 
-def _str_to_bool(value: Optional[str], default: bool = False) -> bool:
+def _str_to_bool(
+    value: Optional[str],
+    default: bool = False,
+    _true: frozenset = _BOOLEAN_TRUE_VALUES,
+    _false: frozenset = _BOOLEAN_FALSE_VALUES,
+) -> bool:
     if value is None:
         return default
     normalized = value.strip().lower()
-    if not normalized:
-        return default
-    if normalized in _BOOLEAN_TRUE_VALUES:
+    if normalized == "true" or normalized == "1":
+        return True
+    if normalized == "false" or normalized == "0":
+        return False
+    if normalized in _true:
         return True
-    if normalized in _BOOLEAN_FALSE_VALUES:
+    if normalized in _false:
         return False
     return default
 
@@ -503,11 +597,25 @@ def _env_flag(*names: str) -> Optional[bool]:
     return None
 
 
+@functools.lru_cache(maxsize=64)
+def _versioned_setting(key: str, default: str, version: int) -> str:
+    return db.get_setting(key, default)
+
+
+def _branding_setting(key: str, default: str) -> str:
+    """Настройка брендинга из кэша; запись через db.set_setting меняет версию и сбрасывает его."""
+    return _versioned_setting(key, default, db.settings_version)
+
+
+VIP_FLAG_CACHE_TTL = 60.0
+_vip_branding_cache: Optional[Tuple[float, int, bool]] = None
+
+
 def get_creator_contact_url() -> str:
     env_value = os.getenv("CREATOR_CONTACT_URL")
     if env_value:
         return _normalize_creator_link(env_value)
-    setting_value = db.get_setting("creator_contact_url", CONSTRUCTOR_BOT_LINK or "")
+    setting_value = _branding_setting("creator_contact_url", CONSTRUCTOR_BOT_LINK or "")
     if setting_value:
         return _normalize_creator_link(setting_value)
     return _normalize_creator_link(CONSTRUCTOR_BOT_LINK)
@@ -518,7 +626,7 @@ def get_creator_contact_label() -> str:
     if env_value:
         return env_value.strip()
     fallback_label = _derive_creator_label("", get_creator_contact_url()) or CREATOR_USERNAME_DEFAULT
-    setting_value = (db.get_setting("creator_contact_label", CREATOR_CONTACT_LABEL_DEFAULT) or "").strip()
+    setting_value = (_branding_setting("creator_contact_label", CREATOR_CONTACT_LABEL_DEFAULT) or "").strip()
     if not setting_value or setting_value in LEGACY_CREATOR_LABELS:
         return fallback_label
     return setting_value
@@ -528,22 +636,34 @@ def get_creator_button_label() -> str:
     env_value = os.getenv("CREATOR_CONTACT_BUTTON_LABEL")
     if env_value:
         return env_value.strip()
-    setting_value = db.get_setting("creator_contact_button_label", CREATOR_CONTACT_BUTTON_LABEL_DEFAULT)
+    setting_value = _branding_setting("creator_contact_button_label", CREATOR_CONTACT_BUTTON_LABEL_DEFAULT)
     if setting_value:
         return setting_value.strip()
     return CREATOR_CONTACT_BUTTON_LABEL_DEFAULT
 
 
-def is_vip_branding_disabled() -> bool:
+def _resolve_vip_branding_disabled() -> bool:
     env_value = _env_flag(*_VIP_ENV_FLAGS)
     if env_value is not None:
         return env_value
     if CREATOR_VIP_FLAG is not None:
         return CREATOR_VIP_FLAG
-    setting_value = db.get_setting("vip_branding_disabled", "false")
+    setting_value = _branding_setting("vip_branding_disabled", "false")
     return _str_to_bool(setting_value, False)
 
 
+def is_vip_branding_disabled() -> bool:
+    global _vip_branding_cache
+    now = time.monotonic()
+    version = db.settings_version
+    cached = _vip_branding_cache
+    if cached is not None and cached[1] == version and now - cached[0] < VIP_FLAG_CACHE_TTL:
+        return cached[2]
+    value = _resolve_vip_branding_disabled()
+    _vip_branding_cache = (now, version, value)
+    return value
+
+
 def is_creator_branding_active() -> bool:
     if is_vip_branding_disabled():
         return False
@@ -551,18 +671,21 @@ def is_creator_branding_active() -> bool:
     if env_flag is not None:
         enabled = env_flag
     else:
-        enabled = _str_to_bool(db.get_setting("creator_branding_enabled", "true"), True)
+        enabled = _str_to_bool(_branding_setting("creator_branding_enabled", "true"), True)
     if not enabled:
         return False
     return bool(get_creator_contact_url() or get_creator_contact_label())
 
 
+_BRANDING_PLACEHOLDER_RE = re.compile(r"\{(label_html|label|link)\}")
+
+
 def render_creator_branding_text() -> Optional[str]:
     if not is_creator_branding_active():
         return None
     template = os.getenv("CREATOR_BRANDING_MESSAGE")
     if template is None:
-        template = db.get_setting("creator_branding_message", "🤖 Бот создан с помощью {label_html}")
+        template = _branding_setting("creator_branding_message", "🤖 Бот создан с помощью {label_html}")
     template = template.strip()
     if not template:
         return None
@@ -574,17 +697,12 @@ def render_creator_branding_text() -> Optional[str]:
         "label_html": label_html or "",
         "link": link or "",
     }
-    try:
-        return template.format(**context)
-    except KeyError:
-        return (
-            template.replace("{label_html}", context["label_html"])
-            .replace("{label}", context["label"])
-            .replace("{link}", context["link"])
-        )
+    # Один проход по шаблону; незнакомые {…} остаются как есть, исключений нет
+    return _BRANDING_PLACEHOLDER_RE.sub(lambda match: context[match.group(1)], template)
 
 
-def build_creator_branding_button() -> Optional[types.InlineKeyboardButton]:
+@functools.lru_cache(maxsize=1)
+def _creator_branding_button_for_version(version: int) -> Optional[types.InlineKeyboardButton]:
     if not is_creator_branding_active():
         return None
     link = get_creator_contact_url()
@@ -596,8 +714,9 @@ def build_creator_branding_button() -> Optional[types.InlineKeyboardButton]:
     return types.InlineKeyboardButton(text, url=link)
 
 
-def build_creator_branding_markup() -> Optional[types.InlineKeyboardMarkup]:
-    button = build_creator_branding_button()
+@functools.lru_cache(maxsize=1)
+def _creator_branding_markup_for_version(version: int) -> Optional[types.InlineKeyboardMarkup]:
+    button = _creator_branding_button_for_version(version)
     if not button:
         return None
     markup = types.InlineKeyboardMarkup(row_width=1)
@@ -605,6 +724,15 @@ def build_creator_branding_markup() -> Optional[types.InlineKeyboardMarkup]:
     return markup
 
 
+# Кнопка и клавиатура брендинга собираются один раз на версию настроек и только читаются
+def build_creator_branding_button() -> Optional[types.InlineKeyboardButton]:
+    return _creator_branding_button_for_version(db.settings_version)
+
+
+def build_creator_branding_markup() -> Optional[types.InlineKeyboardMarkup]:
+    return _creator_branding_markup_for_version(db.settings_version)
+
+
 def send_creator_branding_banner(chat_id: int) -> None:
     if not is_creator_branding_active():
         return
@@ -633,14 +761,231 @@ def convert_admin_value(value_type: str, raw_text: str) -> Tuple[bool, Optional[
         return False, None, "Введите корректное число."
 
 
+# Индексы под частые выборки. pending_tasks(user_id, context, ...), deposit_requests(invoice_id)
+# и promo_tasks(signature) уже покрыты UNIQUE-ограничениями таблиц.
+SCHEMA_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS idx_task_logs_user_sig_ctx ON task_logs(user_id, signature, context)",
+    "CREATE INDEX IF NOT EXISTS idx_users_referrer ON users(referrer_id)",
+    "CREATE INDEX IF NOT EXISTS idx_subwatch_completed_created ON subscription_watchlist(completed, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_required_channels_category ON required_channels(category)",
+    "CREATE INDEX IF NOT EXISTS idx_custom_tasks_placement_active ON custom_tasks(placement, is_active)",
+    "CREATE INDEX IF NOT EXISTS idx_users_created ON users(created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_withdraw_created ON withdraw_requests(created_at)",
+    # Частичные индексы по активным промо-заданиям: список заданий и кабинет рекламодателя
+    "CREATE INDEX IF NOT EXISTS idx_promo_active_created ON promo_tasks(created_at DESC) WHERE is_active = 1",
+    "CREATE INDEX IF NOT EXISTS idx_promo_creator_active"
+    " ON promo_tasks(creator_id, created_at DESC) WHERE is_active = 1",
+    "CREATE INDEX IF NOT EXISTS idx_promo_creator_inactive"
+    " ON promo_tasks(creator_id, created_at DESC) WHERE is_active = 0",
+    "CREATE INDEX IF NOT EXISTS idx_pending_sig ON pending_tasks(signature)",
+)
+
+
+# Чтение идёт без общей блокировки, поэтому обработчики апдейтов могут работать параллельно.
+# Пул читателей рассчитан на все такие потоки плюс два фоновых (проверки Flyer и подписок)
+BOT_WORKER_THREADS = 4
+READ_POOL_SIZE = BOT_WORKER_THREADS + 2
+BUSY_TIMEOUT_MS = 30000
+MMAP_SIZE_BYTES = 256 * 1024 * 1024
+# Кэш страниц в KiB (отрицательное значение для PRAGMA cache_size): у писателя больше,
+# у каждого читателя меньше — страницы и так читаются через общий mmap
+WRITER_CACHE_KIB = 65536
+READER_CACHE_KIB = 16384
+# Устаревшие обозначения валюты, которые _migrate_settings заменяет на USDT
+_LEGACY_CURRENCY_SYMBOLS = frozenset({"₽"})
+_LEGACY_CURRENCY_CODES = frozenset({"RUB", "RUBLE", "RUBLES", "РУБ", "РУБЛЬ", "РУБЛЕЙ"})
+_DROP_DOTS_AND_SPACES = str.maketrans("", "", ". ")
+BALANCE_EPSILON = 1e-9
+# RETURNING доступен начиная с SQLite 3.35
+_SQLITE_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+STAT_TOTAL_EARNED = "total_earned"
+STAT_TOTAL_TOPUPS = "total_topups"
+# Запросов в Storage около сотни — кэш с запасом, чтобы подготовленные выражения не вытеснялись
+STATEMENT_CACHE_SIZE = 256
+# ANALYZE просматривает не больше стольких строк на индекс: статистика приблизительная, но быстрая
+ANALYSIS_LIMIT = 1000
+# Сколько секунд список заданий пользователя отдаётся из памяти без запроса к БД
+PENDING_TASKS_CACHE_TTL = 5.0
+
+
+def _copy_pending_rows(rows: Sequence[Tuple[int, Dict[str, Any]]]) -> List[Tuple[int, Dict[str, Any]]]:
+    """Копия списка заданий для вызывающего: правки не затрагивают кэш Storage."""
+    return [(task_id, dict(task)) for task_id, task in rows]
+
+
+@dataclass(frozen=True)
+class AboutStats:
+    total_users: int
+    new_users: int
+    total_tasks: int
+    total_withdrawn: Decimal
+    withdrawn_since: Decimal
+    total_topups: Decimal
+
+
 class Storage:
-    """Thread-safe SQLite helper."""
+    """Thread-safe SQLite helper.
+
+    Запись идёт через одно соединение под ``_lock``; чтение — через пул
+    read-only соединений, которые в режиме WAL не ждут писателя.
+    """
+
+    # Запросы горячего пути вынесены в константы: одна и та же строка всегда попадает
+    # в кэш подготовленных выражений sqlite3 (cached_statements)
+    _SQL_UPSERT_USER = """
+        INSERT INTO users (user_id, username, first_name, language_code, referrer_id, last_seen)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            username = excluded.username,
+            first_name = excluded.first_name,
+            language_code = COALESCE(excluded.language_code, language_code),
+            last_seen = excluded.last_seen
+    """
+    _SQL_GET_USER = "SELECT * FROM users WHERE user_id = ?"
+    _SQL_UPDATE_BALANCE = """
+        UPDATE users
+        SET balance = balance + ?,
+            withdrawn_total = withdrawn_total + ?,
+            promo_balance = COALESCE(promo_balance, 0) + ?,
+            frozen_balance = COALESCE(frozen_balance, 0) + ?,
+            completed_tasks = completed_tasks + ?
+        WHERE user_id = ?
+    """
+    _SQL_INSERT_TASK_LOG = """
+        INSERT INTO task_logs (user_id, signature, source, context, reward, completed_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """
+    # Списание без предварительного SELECT: строка обновится, только если балансы не уйдут в минус.
+    # Допуск покрывает погрешность REAL-колонок при списании всего остатка.
+    _SQL_UPDATE_BALANCE_GUARDED = _SQL_UPDATE_BALANCE.rstrip() + f"""
+          AND balance + ? >= -{BALANCE_EPSILON}
+          AND COALESCE(promo_balance, 0) + ? >= -{BALANCE_EPSILON}
+    """
+    _SQL_ADD_STAT = "UPDATE stats SET value = value + ? WHERE key = ?"
+    # Списки заданий запрашиваются при каждом открытии меню заданий.
+    # Порядок колонок фиксирован: get_or_refresh_tasks распаковывает строки позиционно.
+    _SQL_LIST_PROMO_TASKS = """
+        SELECT signature, title, description, url, button_text,
+               cost_per_completion, channel_id, channel_link
+        FROM promo_tasks
+        WHERE is_active = 1
+          AND COALESCE(completed_count, 0) < completions
+        ORDER BY created_at DESC
+    """
+    # Колонки для экранов «Мои задания»; created_at нужен для ORDER BY в UNION ALL
+    _PROMO_SUMMARY_COLUMNS = "id, title, completed_count, completions, total_cost, created_at"
+    _SQL_LIST_CUSTOM_TASKS = """
+        SELECT id, title, description, url, button_text, channel_id, reward
+        FROM custom_tasks
+        WHERE placement = ? AND is_active = 1
+        ORDER BY id
+    """
 
     def __init__(self, path: str) -> None:
         self._lock = threading.Lock()
-        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn = sqlite3.connect(path, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
         self._conn.row_factory = sqlite3.Row
+        self._in_memory = path == ":memory:"
+        self._configure_connection()
+        self._settings_version = 0
+        # Все настройки в памяти: загружаются целиком при первом чтении, set_setting пишет насквозь
+        self._settings_cache: Optional[Dict[str, str]] = None
+        # (user_id, context) -> (monotonic-время, кортеж строк list_pending_tasks);
+        # любые удаления из pending_tasks сбрасывают кэш, save_tasks кладёт свежий список.
+        # Поколение (меняется под _lock) не даёт читателю сохранить список,
+        # прочитанный до удаления или до save_tasks
+        self._pending_cache: Dict[Tuple[int, str], Tuple[float, Tuple[Tuple[int, Dict[str, Any]], ...]]] = {}
+        self._pending_generation = 0
         self._init_schema()
+        # Read-only URI открывается только для существующего файла — после создания схемы.
+        # У базы в памяти второго соединения нет: чтение идёт через основное под блокировкой
+        self._read_uri: Optional[str] = None
+        if not self._in_memory:
+            self._read_uri = Path(path).resolve().as_uri() + "?mode=ro"
+        self._read_pool: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue(maxsize=READ_POOL_SIZE)
+        # Без sqlite_stat1 планировщик не знает селективность индексов — собираем её при первом запуске
+        self.optimize(analyze=not self._has_planner_stats())
+
+    def _configure_connection(self) -> None:
+        if not self._in_memory:
+            # WAL: чтение не блокирует запись, а synchronous=NORMAL в WAL безопасен и реже делает fsync
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(f"PRAGMA mmap_size={MMAP_SIZE_BYTES}")
+        self._conn.execute("PRAGMA temp_store=MEMORY")
+        self._conn.execute(f"PRAGMA cache_size=-{WRITER_CACHE_KIB}")
+        self._conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+
+    def _open_read_conn(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self._read_uri, uri=True, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE
+        )
+        conn.row_factory = sqlite3.Row
+        # Настройки применяются один раз при открытии: дальше соединение живёт в пуле
+        conn.execute("PRAGMA query_only=1")
+        conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        conn.execute(f"PRAGMA mmap_size={MMAP_SIZE_BYTES}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute(f"PRAGMA cache_size=-{READER_CACHE_KIB}")
+        return conn
+
+    @contextmanager
+    def _read(self) -> Iterator[sqlite3.Connection]:
+        """Выдаёт соединение для чтения из пула (или открывает новое)."""
+        if self._read_uri is None:
+            with self._lock:
+                yield self._conn
+            return
+        try:
+            conn = self._read_pool.get_nowait()
+        except queue.Empty:
+            conn = self._open_read_conn()
+        try:
+            yield conn
+        finally:
+            try:
+                self._read_pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+
+    def _has_planner_stats(self) -> bool:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'"
+            ).fetchone()
+        return row is not None
+
+    def optimize(self, *, analyze: bool = False) -> None:
+        """
+        Обновляет статистику планировщика запросов. analyze=True пересобирает её
+        полностью, иначе PRAGMA optimize обновляет только устаревшую.
+        """
+        with self._lock:
+            try:
+                self._conn.execute(f"PRAGMA analysis_limit={ANALYSIS_LIMIT}")
+                self._conn.execute("ANALYZE" if analyze else "PRAGMA optimize")
+            except sqlite3.Error as exc:
+                logger.warning("SQLite optimize failed: %s", exc)
+
+    def close(self) -> None:
+        """Сбрасывает WAL в основной файл и закрывает соединения."""
+        while True:
+            try:
+                self._read_pool.get_nowait().close()
+            except queue.Empty:
+                break
+        self.optimize()
+        with self._lock:
+            try:
+                self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            except sqlite3.Error as exc:
+                logger.warning("WAL checkpoint failed: %s", exc)
+            self._conn.close()
+
+    @property
+    def settings_version(self) -> int:
+        """Счётчик изменений settings: растёт при каждом set_setting."""
+        return self._settings_version
 
     def _init_schema(self) -> None:
         with self._conn:
@@ -745,10 +1090,15 @@ class Storage:
                 )
                 """
             )
-            self._ensure_column("promo_tasks", "channel_id TEXT")
-            self._ensure_column("promo_tasks", "channel_username TEXT")
-            self._ensure_column("promo_tasks", "channel_link TEXT")
-            self._ensure_column("promo_tasks", "completed_count INTEGER NOT NULL DEFAULT 0")
+            self._ensure_columns(
+                "promo_tasks",
+                (
+                    "channel_id TEXT",
+                    "channel_username TEXT",
+                    "channel_link TEXT",
+                    "completed_count INTEGER NOT NULL DEFAULT 0",
+                ),
+            )
             self._conn.execute(
                 """
                 CREATE TABLE IF NOT EXISTS subscription_watchlist (
@@ -804,24 +1154,52 @@ class Storage:
                 )
                 """
             )
+            # Накопительные итоги для статистики (в единицах 1e-8), чтобы не суммировать таблицы
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS stats (
+                    key TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL DEFAULT 0
+                )
+                """
+            )
+            for index_sql in SCHEMA_INDEXES:
+                self._conn.execute(index_sql)
         self._bootstrap_settings()
         self._migrate_schema()
         self._migrate_settings()
         self._normalize_initial_balances()
+        self._rebuild_stats()
+
+    def _rebuild_stats(self) -> None:
+        # Полный пересчёт один раз при запуске; дальше итоги поддерживаются в тех же транзакциях, что и данные
+        topups_expr = "balance + withdrawn_total + COALESCE(frozen_balance,0) + COALESCE(promo_balance,0)"
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"""
+                INSERT OR REPLACE INTO stats (key, value)
+                VALUES
+                    (?, (SELECT {_money_units_sum_sql('reward')} FROM task_logs)),
+                    (?, (SELECT {_money_units_sum_sql(topups_expr)} FROM users))
+                """,
+                (STAT_TOTAL_EARNED, STAT_TOTAL_TOPUPS),
+            )
+
+    def _read_stat(self, key: str) -> Decimal:
+        with self._read() as conn:
+            row = conn.execute("SELECT value FROM stats WHERE key = ?", (key,)).fetchone()
+        return _money_from_units(row["value"] if row else 0)
 
     def _migrate_settings(self) -> None:
         with self._lock, self._conn:
             cur = self._conn.execute("SELECT value FROM settings WHERE key = 'currency_symbol'")
             row = cur.fetchone()
             current = (row["value"] or "").strip() if row else ""
-            normalized = current.replace(".", "").replace(" ", "")
-            normalized_upper = normalized.upper()
-            legacy_symbols = {"₽"}
-            legacy_codes = {"RUB", "RUBLE", "RUBLES", "РУБ", "РУБЛЬ", "РУБЛЕЙ"}
+            normalized = current.translate(_DROP_DOTS_AND_SPACES).upper()
             is_legacy = (
                 not normalized
-                or current in legacy_symbols
-                or normalized_upper in legacy_codes
+                or current in _LEGACY_CURRENCY_SYMBOLS
+                or normalized in _LEGACY_CURRENCY_CODES
             )
             if is_legacy:
                 if row:
@@ -837,6 +1215,20 @@ class Storage:
 
     def _normalize_initial_balances(self) -> None:
         with self._lock, self._conn:
+            # Дешёвая проверка: в рабочем состоянии кандидатов обычно нет, и тяжёлый UPDATE не нужен
+            candidate = self._conn.execute(
+                """
+                SELECT 1 FROM users
+                WHERE COALESCE(balance, 0) != 0
+                  AND COALESCE(withdrawn_total, 0) = 0
+                  AND COALESCE(completed_tasks, 0) = 0
+                LIMIT 1
+                """
+            ).fetchone()
+            if candidate is None:
+                return
+            # task_logs проверяется по индексу idx_task_logs_user_sig_ctx; для deposit_requests
+            # индекса по user_id нет, и NOT IN строит временный индекс один раз на весь запрос
             self._conn.execute(
                 """
                 UPDATE users
@@ -844,66 +1236,60 @@ class Storage:
                 WHERE COALESCE(balance, 0) != 0
                   AND COALESCE(withdrawn_total, 0) = 0
                   AND COALESCE(completed_tasks, 0) = 0
-                  AND user_id NOT IN (SELECT DISTINCT user_id FROM task_logs)
+                  AND NOT EXISTS (SELECT 1 FROM task_logs WHERE task_logs.user_id = users.user_id)
                   AND user_id NOT IN (
-                      SELECT DISTINCT user_id FROM deposit_requests WHERE status = 'paid'
+                      SELECT user_id FROM deposit_requests WHERE status = 'paid'
                   )
                 """
             )
 
     def _migrate_schema(self) -> None:
         with self._lock, self._conn:
-            self._ensure_column("users", "language_code TEXT")
-            self._ensure_column("users", "frozen_balance REAL NOT NULL DEFAULT 0")
-            self._ensure_column("users", "promo_balance REAL NOT NULL DEFAULT 0")
+            self._ensure_columns(
+                "users",
+                (
+                    "language_code TEXT",
+                    "frozen_balance REAL NOT NULL DEFAULT 0",
+                    "promo_balance REAL NOT NULL DEFAULT 0",
+                ),
+            )
 
-    def _ensure_column(self, table: str, column_def: str) -> None:
-        column_name = column_def.split()[0]
+    def _ensure_columns(self, table: str, column_defs: Iterable[str]) -> None:
+        # Схема таблицы читается один раз на весь набор колонок
         cur = self._conn.execute(f"PRAGMA table_info({table})")
-        existing = {row["name"] for row in cur.fetchall()}
-        if column_name not in existing:
-            self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {column_def}")
+        existing = {row["name"] for row in cur}
+        for column_def in column_defs:
+            if column_def.split()[0] not in existing:
+                self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {column_def}")
 
     def _bootstrap_settings(self) -> None:
         with self._lock, self._conn:
-            for key, value in DEFAULT_SETTINGS.items():
-                self._conn.execute(
-                    "INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)",
-                    (key, value),
-                )
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO settings (key, value) VALUES (?, ?)",
+                DEFAULT_SETTINGS.items(),
+            )
 
     def ensure_user(self, tg_user: telebot.types.User, referrer_id: Optional[int] = None) -> sqlite3.Row:
         language_code = getattr(tg_user, "language_code", None)
+        params = (
+            tg_user.id,
+            tg_user.username,
+            tg_user.first_name,
+            language_code,
+            referrer_id,
+            now_utc().isoformat(timespec="seconds"),
+        )
+        if not _SQLITE_HAS_RETURNING:
+            with self._lock, self._conn:
+                self._conn.execute(self._SQL_UPSERT_USER, params)
+            return self.get_user(tg_user.id)
         with self._lock, self._conn:
-            self._conn.execute(
-                """
-                INSERT OR IGNORE INTO users (user_id, username, first_name, language_code, referrer_id)
-                VALUES (?, ?, ?, ?, ?)
-                """,
-                (tg_user.id, tg_user.username, tg_user.first_name, language_code, referrer_id),
-            )
-            self._conn.execute(
-                """
-                UPDATE users
-                SET username = ?,
-                    first_name = ?,
-                    language_code = COALESCE(?, language_code),
-                    last_seen = ?
-                WHERE user_id = ?
-                """,
-                (
-                    tg_user.username,
-                    tg_user.first_name,
-                    language_code,
-                    now_utc().isoformat(timespec="seconds"),
-                    tg_user.id,
-                ),
-            )
-        return self.get_user(tg_user.id)
+            # Строка читается до выхода из блока: commit выполняется уже после fetchone()
+            return self._conn.execute(self._SQL_UPSERT_USER + " RETURNING *", params).fetchone()
 
     def get_user(self, user_id: int) -> sqlite3.Row:
-        with self._lock:
-            cur = self._conn.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
+        with self._read() as conn:
+            cur = conn.execute(self._SQL_GET_USER, (user_id,))
             row = cur.fetchone()
         if row is None:
             raise ValueError(f"user {user_id} not found")
@@ -929,28 +1315,57 @@ class Storage:
         delta_promo_balance: Decimal = Decimal("0"),
         delta_frozen_balance: Decimal = Decimal("0"),
         inc_completed: int = 0,
-    ) -> None:
+        require_funds: bool = False,
+    ) -> bool:
+        """Изменяет балансы пользователя; возвращает False, если строка не обновлена.
+
+        С ``require_funds=True`` списание атомарно отклоняется, когда основной или
+        рекламный баланс стал бы отрицательным.
+        """
         with self._lock, self._conn:
-            self._conn.execute(
-                """
-                UPDATE users
-                SET balance = balance + ?,
-                    withdrawn_total = withdrawn_total + ?,
-                    promo_balance = COALESCE(promo_balance, 0) + ?,
-                    frozen_balance = COALESCE(frozen_balance, 0) + ?,
-                    completed_tasks = completed_tasks + ?
-                WHERE user_id = ?
-                """,
-                (
-                    float(delta_balance),
-                    float(delta_withdrawn),
-                    float(delta_promo_balance),
-                    float(delta_frozen_balance),
-                    inc_completed,
-                    user_id,
-                ),
+            return self._update_user_balance_locked(
+                user_id,
+                delta_balance=delta_balance,
+                delta_withdrawn=delta_withdrawn,
+                delta_promo_balance=delta_promo_balance,
+                delta_frozen_balance=delta_frozen_balance,
+                inc_completed=inc_completed,
+                require_funds=require_funds,
             )
 
+    # Методы *_locked выполняются внутри уже открытой транзакции под self._lock —
+    # так несколько изменений можно зафиксировать одним коммитом
+    def _update_user_balance_locked(
+        self,
+        user_id: int,
+        *,
+        delta_balance: Decimal = Decimal("0"),
+        delta_withdrawn: Decimal = Decimal("0"),
+        delta_promo_balance: Decimal = Decimal("0"),
+        delta_frozen_balance: Decimal = Decimal("0"),
+        inc_completed: int = 0,
+        require_funds: bool = False,
+    ) -> bool:
+        topups_delta = _money_to_units(
+            dec(delta_balance) + dec(delta_withdrawn) + dec(delta_promo_balance) + dec(delta_frozen_balance)
+        )
+        params: Tuple[Any, ...] = (
+            float(delta_balance),
+            float(delta_withdrawn),
+            float(delta_promo_balance),
+            float(delta_frozen_balance),
+            inc_completed,
+            user_id,
+        )
+        sql = self._SQL_UPDATE_BALANCE
+        if require_funds:
+            sql = self._SQL_UPDATE_BALANCE_GUARDED
+            params += (float(delta_balance), float(delta_promo_balance))
+        cur = self._conn.execute(sql, params)
+        if topups_delta and cur.rowcount:
+            self._conn.execute(self._SQL_ADD_STAT, (topups_delta, STAT_TOTAL_TOPUPS))
+        return cur.rowcount > 0
+
     def add_task_log(
         self,
         user_id: int,
@@ -960,72 +1375,113 @@ class Storage:
         reward: Decimal,
     ) -> None:
         with self._lock, self._conn:
-            self._conn.execute(
-                """
-                INSERT INTO task_logs (user_id, signature, source, context, reward, completed_at)
-                VALUES (?, ?, ?, ?, ?, ?)
-                """,
-                (
-                    user_id,
-                    signature,
-                    source,
-                    context,
-                    float(reward),
-                    now_utc().isoformat(timespec="seconds"),
-                ),
-            )
+            self._add_task_log_locked(user_id, signature, source, context, reward)
 
-    def save_tasks(self, user_id: int, context: str, tasks: List[Dict[str, Any]]) -> None:
+    def _add_task_log_locked(
+        self,
+        user_id: int,
+        signature: str,
+        source: str,
+        context: str,
+        reward: Decimal,
+    ) -> None:
+        self._conn.execute(
+            self._SQL_INSERT_TASK_LOG,
+            (
+                user_id,
+                signature,
+                source,
+                context,
+                float(reward),
+                now_utc().isoformat(timespec="seconds"),
+            ),
+        )
+        self._conn.execute(self._SQL_ADD_STAT, (_money_to_units(reward), STAT_TOTAL_EARNED))
+
+    def save_tasks(self, user_id: int, context: str, tasks: List[Dict[str, Any]]) -> List[Tuple[int, Dict[str, Any]]]:
+        """
+        Заменяет список заданий пользователя и возвращает его в формате list_pending_tasks.
+        Payload берётся из переданных словарей, поэтому повторный разбор JSON не нужен.
+        """
+        # Сериализуем до захвата блокировки: под ней остаётся только работа с БД
+        rows = [
+            (
+                user_id,
+                context,
+                task["signature"],
+                task.get("source", "flyer"),
+                _dump_payload(task),
+            )
+            for task in tasks
+        ]
         with self._lock, self._conn:
             self._conn.execute(
                 "DELETE FROM pending_tasks WHERE user_id = ? AND context = ?",
                 (user_id, context),
             )
-            for task in tasks:
-                self._conn.execute(
-                    """
-                    INSERT OR REPLACE INTO pending_tasks (user_id, context, signature, source, payload)
-                    VALUES (?, ?, ?, ?, ?)
-                    """,
-                    (
-                        user_id,
-                        context,
-                        task["signature"],
-                        task.get("source", "flyer"),
-                        json.dumps(task, ensure_ascii=False),
-                    ),
-                )
+            self._conn.executemany(
+                """
+                INSERT OR REPLACE INTO pending_tasks (user_id, context, signature, source, payload)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                rows,
+            )
+            saved = self._conn.execute(
+                "SELECT id, signature FROM pending_tasks WHERE user_id = ? AND context = ? ORDER BY id",
+                (user_id, context),
+            ).fetchall()
+        by_signature = {task["signature"]: task for task in tasks}
+        result = [(row["id"], by_signature[row["signature"]]) for row in saved]
+        with self._lock:
+            self._pending_generation += 1
+            self._pending_cache[(user_id, context)] = (time.monotonic(), tuple(result))
+        return _copy_pending_rows(result)
 
     def load_tasks(self, user_id: int, context: str) -> List[Dict[str, Any]]:
-        with self._lock:
-            cur = self._conn.execute(
+        with self._read() as conn:
+            cur = conn.execute(
                 "SELECT payload FROM pending_tasks WHERE user_id = ? AND context = ?",
                 (user_id, context),
             )
-            payloads = [json.loads(row["payload"]) for row in cur.fetchall()]
-        return payloads
+            rows = cur.fetchall()
+        # Разбор JSON — после возврата соединения в пул
+        return [_load_payload(row["payload"]) for row in rows]
 
     def list_pending_tasks(self, user_id: int, context: str) -> List[Tuple[int, Dict[str, Any]]]:
-        with self._lock:
-            cur = self._conn.execute(
+        cache_key = (user_id, context)
+        cached = self._pending_cache.get(cache_key)
+        if cached is not None and time.monotonic() - cached[0] < PENDING_TASKS_CACHE_TTL:
+            return _copy_pending_rows(cached[1])
+        started = time.monotonic()
+        generation = self._pending_generation
+        with self._read() as conn:
+            cur = conn.execute(
                 "SELECT id, payload FROM pending_tasks WHERE user_id = ? AND context = ? ORDER BY id",
                 (user_id, context),
             )
-            result: List[Tuple[int, Dict[str, Any]]] = []
-            for row in cur.fetchall():
-                result.append((row["id"], json.loads(row["payload"])))
-            return result
+            rows = cur.fetchall()
+        result = [(row["id"], _load_payload(row["payload"])) for row in rows]
+        with self._lock:
+            if generation == self._pending_generation:
+                self._pending_cache[cache_key] = (started, tuple(result))
+        return _copy_pending_rows(result)
 
-    def get_pending_task(self, task_id: int) -> Optional[Dict[str, Any]]:
+    def _invalidate_pending_cache(self) -> None:
+        """Вызывается после коммита удаления из pending_tasks (вне _lock)."""
         with self._lock:
-            cur = self._conn.execute(
+            self._pending_generation += 1
+            self._pending_cache.clear()
+
+    def get_pending_task(self, task_id: int) -> Optional[Dict[str, Any]]:
+        with self._read() as conn:
+            cur = conn.execute(
                 "SELECT user_id, context, payload FROM pending_tasks WHERE id = ?",
                 (task_id,),
             )
             row = cur.fetchone()
         if not row:
             return None
-        data = json.loads(row["payload"])
+        data = _load_payload(row["payload"])
         data["_user_id"] = row["user_id"]
         data["_context"] = row["context"]
         return data
@@ -1033,6 +1489,7 @@ class Storage:
     def delete_pending_task(self, task_id: int) -> None:
         with self._lock, self._conn:
             self._conn.execute("DELETE FROM pending_tasks WHERE id = ?", (task_id,))
+        self._invalidate_pending_cache()
 
     def add_subscription_watch(
         self,
@@ -1082,21 +1539,50 @@ class Storage:
                 ORDER BY created_at
             """
             params = [user_id]
-        with self._lock:
-            cur = self._conn.execute(query, params)
+        with self._read() as conn:
+            cur = conn.execute(query, params)
             return cur.fetchall()
 
     def mark_watch_completed(self, watch_id: int, *, penalized: bool = False) -> None:
         with self._lock, self._conn:
-            self._conn.execute(
-                """
-                UPDATE subscription_watchlist
-                SET completed = 1,
-                    penalty_applied = CASE WHEN ? THEN 1 ELSE penalty_applied END
-                WHERE id = ?
-                """,
-                (1 if penalized else 0, watch_id),
-            )
+            self._mark_watch_completed_locked(watch_id, penalized=penalized)
+
+    def _mark_watch_completed_locked(self, watch_id: int, *, penalized: bool = False) -> None:
+        self._conn.execute(
+            """
+            UPDATE subscription_watchlist
+            SET completed = 1,
+                penalty_applied = CASE WHEN ? THEN 1 ELSE penalty_applied END
+            WHERE id = ?
+            """,
+            (1 if penalized else 0, watch_id),
+        )
+
+    def settle_subscription_watch(
+        self,
+        watch_id: int,
+        *,
+        user_id: int,
+        signature: str,
+        source: str,
+        reward: Decimal,
+        penalized: bool,
+    ) -> None:
+        """
+        Закрывает проверку подписки одной транзакцией: при успехе переводит награду
+        из удержания на баланс, при отписке списывает её с удержания.
+        """
+        with self._lock, self._conn:
+            if reward > 0:
+                if penalized:
+                    self._update_user_balance_locked(user_id, delta_frozen_balance=-reward)
+                    self._add_task_log_locked(user_id, signature, source, "penalty", -reward)
+                else:
+                    self._update_user_balance_locked(
+                        user_id, delta_frozen_balance=-reward, delta_balance=reward
+                    )
+                    self._add_task_log_locked(user_id, signature, source, "frozen_to_balance", reward)
+            self._mark_watch_completed_locked(watch_id, penalized=penalized)
 
     def update_watch_last_checked(self, watch_id: int, when: datetime) -> None:
         with self._lock, self._conn:
@@ -1105,72 +1591,156 @@ class Storage:
                 (when.isoformat(timespec="seconds"), watch_id),
             )
 
-    def get_setting(self, key: str, default: Optional[str] = None) -> str:
+    def _load_settings_cache(self) -> Dict[str, str]:
+        # Под блокировкой записи: параллельный set_setting не потеряется в загружаемом снимке
         with self._lock:
-            cur = self._conn.execute("SELECT value FROM settings WHERE key = ?", (key,))
-            row = cur.fetchone()
-        if row:
-            return row["value"]
+            cache = self._settings_cache
+            if cache is None:
+                cur = self._conn.execute("SELECT key, value FROM settings")
+                cache = {row["key"]: row["value"] for row in cur.fetchall()}
+                self._settings_cache = cache
+        return cache
+
+    def get_setting(self, key: str, default: Optional[str] = None) -> str:
+        cache = self._settings_cache
+        if cache is None:
+            cache = self._load_settings_cache()
+        value = cache.get(key)
+        if value is not None:
+            return value
         return DEFAULT_SETTINGS.get(key, default or "")
 
+    def get_settings_bulk(self, keys: Iterable[str]) -> Dict[str, str]:
+        """Несколько настроек из одного снимка кэша; отсутствующие — из DEFAULT_SETTINGS."""
+        cache = self._settings_cache
+        if cache is None:
+            cache = self._load_settings_cache()
+        result: Dict[str, str] = {}
+        for key in keys:
+            value = cache.get(key)
+            result[key] = value if value is not None else DEFAULT_SETTINGS.get(key, "")
+        return result
+
     def set_setting(self, key: str, value: str) -> None:
         with self._lock, self._conn:
             self._conn.execute(
                 "INSERT INTO settings (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
                 (key, value),
             )
+            if self._settings_cache is not None:
+                self._settings_cache[key] = value
+            self._settings_version += 1
+
+    def set_settings_bulk(self, items: Iterable[Tuple[str, str]]) -> None:
+        """Записывает несколько настроек одной транзакцией."""
+        pairs = [(str(key), str(value)) for key, value in items]
+        if not pairs:
+            return
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO settings (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                pairs,
+            )
+            if self._settings_cache is not None:
+                self._settings_cache.update(pairs)
+            self._settings_version += 1
 
     def all_user_ids(self) -> List[int]:
-        with self._lock:
-            cur = self._conn.execute("SELECT user_id FROM users")
-            return [row["user_id"] for row in cur.fetchall()]
+        return list(self.iter_user_ids())
+
+    def iter_user_ids(self, chunk: int = 1000) -> Iterator[int]:
+        """Идентификаторы пользователей порциями по возрастанию user_id.
+
+        Каждая порция — отдельный короткий запрос по первичному ключу: между порциями
+        соединение возвращается в пул и не держит снимок WAL на время долгой рассылки.
+        """
+        last_id: Optional[int] = None
+        while True:
+            with self._read() as conn:
+                if last_id is None:
+                    cur = conn.execute("SELECT user_id FROM users ORDER BY user_id LIMIT ?", (chunk,))
+                else:
+                    cur = conn.execute(
+                        "SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?",
+                        (last_id, chunk),
+                    )
+                ids = [row[0] for row in cur.fetchall()]
+            yield from ids
+            if len(ids) < chunk:
+                return
+            last_id = ids[-1]
 
     def count_users(self) -> int:
-        with self._lock:
-            cur = self._conn.execute("SELECT COUNT(*) as c FROM users")
+        with self._read() as conn:
+            cur = conn.execute("SELECT COUNT(*) as c FROM users")
             return cur.fetchone()["c"]
 
     def count_new_users(self, since: datetime) -> int:
-        with self._lock:
-            cur = self._conn.execute(
-                "SELECT COUNT(*) AS c FROM users WHERE datetime(created_at) >= ?",
-                (since.isoformat(timespec="seconds"),),
+        with self._read() as conn:
+            # users.created_at пишется через CURRENT_TIMESTAMP (UTC, "YYYY-MM-DD HH:MM:SS"):
+            # сравниваем строку в том же формате, чтобы работал индекс по created_at
+            cur = conn.execute(
+                "SELECT COUNT(*) AS c FROM users WHERE created_at >= ?",
+                (since.astimezone(UTC).strftime("%Y-%m-%d %H:%M:%S"),),
             )
             return cur.fetchone()["c"]
 
     def total_earned(self) -> Decimal:
-        with self._lock:
-            cur = self._conn.execute("SELECT COALESCE(SUM(reward),0) as total FROM task_logs")
-            return dec(cur.fetchone()["total"], "0")
+        return self._read_stat(STAT_TOTAL_EARNED)
 
     def total_completed_tasks(self) -> int:
-        with self._lock:
-            cur = self._conn.execute("SELECT COUNT(*) as c FROM task_logs")
+        with self._read() as conn:
+            cur = conn.execute("SELECT COUNT(*) as c FROM task_logs")
             return cur.fetchone()["c"]
 
     def total_withdrawn_amount(self) -> Decimal:
-        with self._lock:
-            cur = self._conn.execute("SELECT COALESCE(SUM(withdrawn_total), 0) as total FROM users")
-            return dec(cur.fetchone()["total"], "0")
+        with self._read() as conn:
+            cur = conn.execute(f"SELECT {_money_units_sum_sql('withdrawn_total')} AS total FROM users")
+            return _money_from_units(cur.fetchone()["total"])
 
     def withdrawn_amount_since(self, since: datetime) -> Decimal:
-        with self._lock:
-            cur = self._conn.execute(
-                """
-                SELECT COALESCE(SUM(amount), 0) as total
+        with self._read() as conn:
+            cur = conn.execute(
+                f"""
+                SELECT {_money_units_sum_sql('amount')} AS total
                 FROM withdraw_requests
-                WHERE datetime(created_at) >= datetime(?)
+                WHERE created_at >= ?
                 """,
                 (since.isoformat(timespec="seconds"),),
             )
-            return dec(cur.fetchone()["total"], "0")
+            return _money_from_units(cur.fetchone()["total"])
 
     def total_topups(self) -> Decimal:
-        with self._lock:
-            cur = self._conn.execute(
-                "SELECT COALESCE(SUM(balance + withdrawn_total + COALESCE(frozen_balance,0) + COALESCE(promo_balance,0)), 0) as total FROM users"
-            )
-            return dec(cur.fetchone()["total"], "0")
+        return self._read_stat(STAT_TOTAL_TOPUPS)
+
+    def about_stats(self, since: datetime) -> AboutStats:
+        """Все счётчики раздела «Инфо» одним запросом (те же выражения, что в отдельных методах)."""
+        with self._read() as conn:
+            row = conn.execute(
+                f"""
+                SELECT
+                    (SELECT COUNT(*) FROM users) AS total_users,
+                    (SELECT COUNT(*) FROM users WHERE created_at >= ?) AS new_users,
+                    (SELECT COUNT(*) FROM task_logs) AS total_tasks,
+                    (SELECT {_money_units_sum_sql('withdrawn_total')} FROM users) AS total_withdrawn,
+                    (SELECT {_money_units_sum_sql('amount')} FROM withdraw_requests
+                     WHERE created_at >= ?) AS withdrawn_since,
+                    (SELECT value FROM stats WHERE key = ?) AS total_topups
+                """,
+                (
+                    since.astimezone(UTC).strftime("%Y-%m-%d %H:%M:%S"),
+                    since.isoformat(timespec="seconds"),
+                    STAT_TOTAL_TOPUPS,
+                ),
+            ).fetchone()
+        return AboutStats(
+            total_users=row["total_users"],
+            new_users=row["new_users"],
+            total_tasks=row["total_tasks"],
+            total_withdrawn=_money_from_units(row["total_withdrawn"]),
+            withdrawn_since=_money_from_units(row["withdrawn_since"]),
+            total_topups=_money_from_units(row["total_topups"]),
+        )
 
     def create_withdraw_request(
         self,
@@ -1227,8 +1797,8 @@ class Storage:
             return int(cur.lastrowid)
 
     def get_deposit_request(self, invoice_id: str) -> Optional[sqlite3.Row]:
-        with self._lock:
-            cur = self._conn.execute(
+        with self._read() as conn:
+            cur = conn.execute(
                 "SELECT * FROM deposit_requests WHERE invoice_id = ?",
                 (str(invoice_id),),
             )
@@ -1242,8 +1812,8 @@ class Storage:
             )
 
     def has_task_completion(self, user_id: int, signature: str, context: str) -> bool:
-        with self._lock:
-            cur = self._conn.execute(
+        with self._read() as conn:
+            cur = conn.execute(
                 """
                 SELECT 1 FROM task_logs
                 WHERE user_id = ? AND signature = ? AND context = ?
@@ -1253,20 +1823,31 @@ class Storage:
             )
             return cur.fetchone() is not None
 
+    def get_completed_signatures(self, user_id: int, context: str) -> Set[str]:
+        """Все подписи выполненных заданий пользователя одним запросом."""
+        with self._read() as conn:
+            cur = conn.execute(
+                """
+                SELECT signature FROM task_logs
+                WHERE user_id = ? AND context = ? AND signature IS NOT NULL
+                """,
+                (user_id, context),
+            )
+            return {row[0] for row in cur.fetchall()}
+
     def referral_counts(self, user_id: int) -> Tuple[int, int]:
-        with self._lock:
-            cur = self._conn.execute("SELECT COUNT(*) as c FROM users WHERE referrer_id = ?", (user_id,))
-            lvl1 = cur.fetchone()["c"]
-            cur = self._conn.execute(
+        with self._read() as conn:
+            cur = conn.execute(
                 """
-                SELECT COUNT(*) as c
-                FROM users
-                WHERE referrer_id IN (SELECT user_id FROM users WHERE referrer_id = ?)
+                WITH lvl1 AS (SELECT user_id FROM users WHERE referrer_id = ?)
+                SELECT
+                    (SELECT COUNT(*) FROM lvl1) AS lvl1,
+                    (SELECT COUNT(*) FROM users WHERE referrer_id IN lvl1) AS lvl2
                 """,
                 (user_id,),
             )
-            lvl2 = cur.fetchone()["c"]
-        return lvl1, lvl2
+            row = cur.fetchone()
+        return row["lvl1"], row["lvl2"]
 
     def add_referral_bonus(self, referrer_id: int, referred_id: int, level: int, amount: Decimal) -> None:
         with self._lock, self._conn:
@@ -1283,19 +1864,40 @@ class Storage:
                     now_utc().isoformat(timespec="seconds"),
                 ),
             )
-            self._conn.execute(
+            cur = self._conn.execute(
                 "UPDATE users SET balance = balance + ? WHERE user_id = ?",
                 (float(amount), referrer_id),
             )
+            if cur.rowcount:
+                self._conn.execute(self._SQL_ADD_STAT, (_money_to_units(amount), STAT_TOTAL_TOPUPS))
 
     def get_required_channels(self, category: str) -> List[sqlite3.Row]:
-        with self._lock:
-            cur = self._conn.execute(
+        with self._read() as conn:
+            cur = conn.execute(
                 "SELECT * FROM required_channels WHERE category = ? ORDER BY id",
                 (category,),
             )
             return cur.fetchall()
 
+    def get_required_channels_many(self, categories: Iterable[str]) -> List[sqlite3.Row]:
+        """Каналы нескольких категорий одним запросом: сгруппированы в порядке categories, внутри — по id."""
+        order = {category: index for index, category in enumerate(categories)}
+        if not order:
+            return []
+        placeholders = ",".join("?" * len(order))
+        with self._read() as conn:
+            rows = conn.execute(
+                f"SELECT * FROM required_channels WHERE category IN ({placeholders}) ORDER BY id",
+                tuple(order),
+            ).fetchall()
+        rows.sort(key=lambda row: order[row["category"]])
+        return rows
+
+    def count_required_channels(self) -> Dict[str, int]:
+        with self._read() as conn:
+            cur = conn.execute("SELECT category, COUNT(*) FROM required_channels GROUP BY category")
+            return {category: count for category, count in cur.fetchall()}
+
     def add_required_channel(self, title: str, channel_id: str, invite_link: str, category: str) -> None:
         with self._lock, self._conn:
             self._conn.execute(
@@ -1312,16 +1914,8 @@ class Storage:
             return cur.rowcount > 0
 
     def list_custom_tasks(self, placement: str) -> List[sqlite3.Row]:
-        with self._lock:
-            cur = self._conn.execute(
-                """
-                SELECT * FROM custom_tasks
-                WHERE placement = ? AND is_active = 1
-                ORDER BY id
-                """,
-                (placement,),
-            )
-            return cur.fetchall()
+        with self._read() as conn:
+            return conn.execute(self._SQL_LIST_CUSTOM_TASKS, (placement,)).fetchall()
 
     def add_custom_task(
         self,
@@ -1394,18 +1988,29 @@ class Storage:
             )
     
     def list_promo_tasks(self) -> List[sqlite3.Row]:
-        with self._lock:
-            cur = self._conn.execute(
-                """
-                SELECT * FROM promo_tasks
-                WHERE is_active = 1
-                  AND COALESCE(completed_count, 0) < completions
-                ORDER BY created_at DESC
-                """
-            )
-            return cur.fetchall()
+        with self._read() as conn:
+            return conn.execute(self._SQL_LIST_PROMO_TASKS).fetchall()
 
     def increment_promo_completion(self, signature: str) -> Tuple[int, int, bool]:
+        if _SQLITE_HAS_RETURNING:
+            with self._lock, self._conn:
+                row = self._conn.execute(
+                    """
+                    UPDATE promo_tasks
+                    SET completed_count = COALESCE(completed_count, 0) + 1,
+                        is_active = CASE
+                            WHEN COALESCE(completed_count, 0) + 1 >= completions THEN 0
+                            ELSE is_active
+                        END
+                    WHERE signature = ?
+                    RETURNING completed_count, completions
+                    """,
+                    (signature,),
+                ).fetchone()
+            if not row:
+                return 0, 0, False
+            new_count, total = row["completed_count"], row["completions"]
+            return new_count, total, new_count >= total
         with self._lock, self._conn:
             row = self._conn.execute(
                 "SELECT completions, completed_count FROM promo_tasks WHERE signature = ?",
@@ -1426,13 +2031,14 @@ class Storage:
     def remove_pending_tasks_by_signature(self, signature: str) -> None:
         with self._lock, self._conn:
             self._conn.execute("DELETE FROM pending_tasks WHERE signature = ?", (signature,))
+        self._invalidate_pending_cache()
 
     def get_user_active_promo_tasks(self, creator_id: int) -> List[sqlite3.Row]:
         """Получить активные промо-задания пользователя (не выполненные)"""
-        with self._lock:
-            cur = self._conn.execute(
-                """
-                SELECT * FROM promo_tasks
+        with self._read() as conn:
+            cur = conn.execute(
+                f"""
+                SELECT {self._PROMO_SUMMARY_COLUMNS} FROM promo_tasks
                 WHERE creator_id = ? 
                   AND is_active = 1
                   AND COALESCE(completed_count, 0) < completions
@@ -1443,35 +2049,48 @@ class Storage:
 
     def get_user_finished_promo_tasks(self, creator_id: int) -> List[sqlite3.Row]:
         """Получить завершенные промо-задания пользователя"""
-        with self._lock:
-            cur = self._conn.execute(
-                """
-                SELECT * FROM promo_tasks
-                WHERE creator_id = ?
-                  AND (is_active = 0 OR COALESCE(completed_count, 0) >= completions)
+        with self._read() as conn:
+            # Две непересекающиеся ветки, каждая идёт по своему частичному индексу
+            cur = conn.execute(
+                f"""
+                SELECT {self._PROMO_SUMMARY_COLUMNS} FROM promo_tasks
+                WHERE creator_id = ? AND is_active = 0
+                UNION ALL
+                SELECT {self._PROMO_SUMMARY_COLUMNS} FROM promo_tasks
+                WHERE creator_id = ? AND is_active = 1
+                  AND COALESCE(completed_count, 0) >= completions
                 ORDER BY created_at DESC
                 """
-            , (creator_id,))
+            , (creator_id, creator_id))
             return cur.fetchall()
 
     def deactivate_promo_task(self, task_id: int, creator_id: int) -> bool:
         """Деактивировать промо-задание (средства не возвращаются)"""
         with self._lock, self._conn:
-            cur = self._conn.execute(
-                "UPDATE promo_tasks SET is_active = 0 WHERE id = ? AND creator_id = ?",
-                (task_id, creator_id),
-            )
-            if cur.rowcount > 0:
-                # Удаляем задание из pending_tasks всех пользователей
+            if _SQLITE_HAS_RETURNING:
                 task_row = self._conn.execute(
-                    "SELECT signature FROM promo_tasks WHERE id = ?", (task_id,)
+                    "UPDATE promo_tasks SET is_active = 0 WHERE id = ? AND creator_id = ? RETURNING signature",
+                    (task_id, creator_id),
                 ).fetchone()
-                if task_row:
-                    self._conn.execute(
-                        "DELETE FROM pending_tasks WHERE signature = ?",
-                        (task_row["signature"],)
-                    )
-            return cur.rowcount > 0
+            else:
+                cur = self._conn.execute(
+                    "UPDATE promo_tasks SET is_active = 0 WHERE id = ? AND creator_id = ?",
+                    (task_id, creator_id),
+                )
+                task_row = None
+                if cur.rowcount > 0:
+                    task_row = self._conn.execute(
+                        "SELECT signature FROM promo_tasks WHERE id = ?", (task_id,)
+                    ).fetchone()
+            if task_row is None:
+                return False
+            # Удаляем задание из pending_tasks всех пользователей
+            self._conn.execute(
+                "DELETE FROM pending_tasks WHERE signature = ?",
+                (task_row["signature"],)
+            )
+        self._invalidate_pending_cache()
+        return True
 
     def deactivate_custom_task(self, task_id: int) -> bool:
         with self._lock, self._conn:
@@ -1500,13 +2119,15 @@ def apply_env_overrides() -> None:
     }
     if overrides.get("vip_branding_disabled") is None and CREATOR_VIP_FLAG is not None:
         overrides["vip_branding_disabled"] = "true" if CREATOR_VIP_FLAG else "false"
+    pending: List[Tuple[str, str]] = []
     for key, value in overrides.items():
         if value is None:
             continue
         cleaned = value.strip()
         if not cleaned:
             continue
-        db.set_setting(key, cleaned)
+        pending.append((key, cleaned))
+    db.set_settings_bulk(pending)
 
 apply_env_overrides()
 
@@ -1525,7 +2146,7 @@ ensure_creator_label_matches_link()
 if BOT_TOKEN in {"", "PASTE_YOUR_TOKEN", "ВАШ_ТОКЕН_ОТ_BOTFATHER_ЗДЕСЬ"}:
     raise RuntimeError("⚠️ УКАЖИТЕ ТОКЕН БОТА! Откройте cashlait_bot.py и замените BOT_TOKEN на ваш токен от @BotFather")
 
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML")
+bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML", num_threads=BOT_WORKER_THREADS)
 try:
     bot_info = bot.get_me()
     BOT_USERNAME = bot_info.username or "CashLait_Bot"
@@ -1534,12 +2155,150 @@ except ApiException as exc:
     raise RuntimeError(f"Не удалось получить информацию о боте: {exc}") from exc
 
 
+HTTP_POOL_CONNECTIONS = 16
+HTTP_POOL_MAXSIZE = 64
+
+
+def _build_http_session() -> requests.Session:
+    """
+    Сессия с пулом keep-alive соединений. Повторяются только ошибки соединения
+    и 502/503/504 для идемпотентных методов: POST (createCheck и т.п.) urllib3
+    по умолчанию повторно не отправляет.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_CONNECTIONS,
+        pool_maxsize=HTTP_POOL_MAXSIZE,
+        max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=(502, 503, 504)),
+    )
+    session.mount("https://", adapter)
+    return session
+
+
+_FLYER_SESSION = _build_http_session()
+_CRYPTO_SESSION = _build_http_session()
+
+
+class TokenBucket:
+    """Ограничение частоты запросов: в среднем rate в секунду, всплеском до burst."""
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.capacity = float(burst)
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take_locked(self) -> bool:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                if self._take_locked():
+                    return
+                wait_for = (1 - self._tokens) / self.rate
+            time.sleep(wait_for)
+
+    def try_acquire(self) -> bool:
+        """Берёт токен без ожидания; False, если их сейчас нет."""
+        with self._lock:
+            return self._take_locked()
+
+
+# Фоновая проверка подписок идёт пачкой — растягиваем её, чтобы не упираться в лимиты Flyer
+FLYER_WATCH_RATE = TokenBucket(rate=5, burst=10)
+# Проверки по одному пользователю идут из обработчиков апдейтов: у них свой лимит без ожидания,
+# при исчерпании проверка пропускается до следующего апдейта или фонового прохода
+FLYER_USER_WATCH_RATE = TokenBucket(rate=2, burst=5)
+
+# Уведомления из фоновых задач отправляются отдельными потоками: медленный ответ Telegram
+# не задерживает обработку следующих записей. Лимиты Telegram: ~30 сообщений/с всего,
+# 1 сообщение/с в личный чат и около 20 в минуту в группу или канал — держимся ниже.
+# Время отправки назначается при постановке в очередь, поэтому пачка сообщений в один чат
+# откладывается в куче и не занимает потоки, пока уходят уведомления другим чатам
+NOTIFY_QUEUE_SIZE = 1000
+NOTIFY_WORKERS = 2
+NOTIFY_PER_CHAT_INTERVAL = 1.0
+NOTIFY_PER_GROUP_INTERVAL = 3.0
+_NOTIFY_RATE = TokenBucket(rate=25, burst=25)
+# (время отправки по monotonic, порядковый номер, chat_id, текст, kwargs)
+_notify_heap: List[Tuple[float, int, Any, str, Dict[str, Any]]] = []
+_notify_seq = itertools.count()
+_notify_next_allowed: Dict[Any, float] = {}
+_notify_cond = threading.Condition()
+
+
+def _notify_interval(chat_id: Any) -> float:
+    """Группы и каналы — отрицательный id или @username — получают более редкий интервал."""
+    if isinstance(chat_id, str):
+        value = chat_id.strip()
+        if value.startswith("@") or value.startswith("-"):
+            return NOTIFY_PER_GROUP_INTERVAL
+        return NOTIFY_PER_CHAT_INTERVAL
+    return NOTIFY_PER_GROUP_INTERVAL if chat_id < 0 else NOTIFY_PER_CHAT_INTERVAL
+
+
+def _send_notification(chat_id: Any, text: str, kwargs: Dict[str, Any]) -> None:
+    _NOTIFY_RATE.acquire()
+    try:
+        bot.send_message(chat_id, text, **kwargs)
+    except ApiException as exc:
+        logger.warning("Не удалось отправить уведомление в %s: %s", chat_id, exc)
+
+
+def _notify_worker() -> None:
+    while True:
+        with _notify_cond:
+            while True:
+                if not _notify_heap:
+                    _notify_cond.wait()
+                    continue
+                delay = _notify_heap[0][0] - time.monotonic()
+                if delay <= 0:
+                    break
+                # Новое сообщение с более ранним временем разбудит поток раньше
+                _notify_cond.wait(delay)
+            _, _, chat_id, text, kwargs = heapq.heappop(_notify_heap)
+        try:
+            _send_notification(chat_id, text, kwargs)
+        except Exception as exc:
+            logger.error("Ошибка отправки уведомления в %s: %s", chat_id, exc, exc_info=True)
+
+
+def notify_async(chat_id: Any, text: str, **kwargs: Any) -> None:
+    """Ставит сообщение в очередь с учётом лимита на чат; при переполнении сообщение отбрасывается."""
+    with _notify_cond:
+        if len(_notify_heap) >= NOTIFY_QUEUE_SIZE:
+            logger.warning("Очередь уведомлений переполнена, сообщение в %s отброшено", chat_id)
+            return
+        now = time.monotonic()
+        if len(_notify_next_allowed) > NOTIFY_QUEUE_SIZE:
+            # Чаты, чей интервал уже истёк, больше не ограничивают отправку
+            for stale_chat in [c for c, t in _notify_next_allowed.items() if t <= now]:
+                del _notify_next_allowed[stale_chat]
+        send_at = max(now, _notify_next_allowed.get(chat_id, 0.0))
+        _notify_next_allowed[chat_id] = send_at + _notify_interval(chat_id)
+        heapq.heappush(_notify_heap, (send_at, next(_notify_seq), chat_id, text, kwargs))
+        _notify_cond.notify()
+
+
+for _worker_index in range(NOTIFY_WORKERS):
+    threading.Thread(target=_notify_worker, name=f"notify-{_worker_index}", daemon=True).start()
+
+
 class FlyerAPI:
     BASE_URL = "https://api.flyerservice.io"
 
-    def __init__(self, api_key: str) -> None:
+    def __init__(self, api_key: str, session: Optional[requests.Session] = None) -> None:
         self.api_key = api_key.strip()
-        self.session = requests.Session()
+        self.session = session or _FLYER_SESSION
 
     def enabled(self) -> bool:
         return bool(self.api_key)
@@ -1559,14 +2318,15 @@ class FlyerAPI:
         logger.info("Flyer get_tasks request=%s", log_payload)
         response = self.session.post(
             f"{self.BASE_URL}/get_tasks",
-            json=payload,
+            data=_dump_json_body(payload),
+            headers=JSON_HEADERS,
             timeout=15,
         )
         response.raise_for_status()
         raw_text = response.text
         logger.info("Flyer get_tasks response status=%s body=%s", response.status_code, raw_text)
         try:
-            data = response.json()
+            data = _load_payload(response.content)
         except ValueError as exc:
             raise RuntimeError(f"Flyer invalid JSON: {raw_text}") from exc
         if data.get("error"):
@@ -1606,14 +2366,15 @@ class FlyerAPI:
         logger.info("Flyer check_task request=%s", log_payload)
         response = self.session.post(
             f"{self.BASE_URL}/check_task",
-            json=payload,
+            data=_dump_json_body(payload),
+            headers=JSON_HEADERS,
             timeout=15,
         )
         response.raise_for_status()
         raw_text = response.text
         logger.info("Flyer check_task response status=%s body=%s", response.status_code, raw_text)
         try:
-            data = response.json()
+            data = _load_payload(response.content)
         except ValueError as exc:
             raise RuntimeError(f"Flyer invalid JSON: {raw_text}") from exc
         if data.get("error"):
@@ -1624,18 +2385,19 @@ class FlyerAPI:
 class CryptoPayClient:
     BASE_URL = os.getenv("CRYPTOPAY_API_URL", "https://pay.crypt.bot/api")
 
-    def __init__(self, token: str) -> None:
+    def __init__(self, token: str, session: Optional[requests.Session] = None) -> None:
         self.token = token.strip()
         if not self.token:
             raise ValueError("Crypto Pay token is empty")
-        self.session = requests.Session()
-        self.session.headers["Crypto-Pay-API-Token"] = self.token
+        # Сессия общая, поэтому токен передаётся заголовком запроса, а не сессии.
+        self.session = session or _CRYPTO_SESSION
+        self._headers = {**JSON_HEADERS, "Crypto-Pay-API-Token": self.token}
 
     def call(self, method: str, payload: Optional[Dict[str, Any]] = None) -> Any:
         url = f"{self.BASE_URL}/{method}"
-        response = self.session.post(url, json=payload or {}, timeout=15)
+        response = self.session.post(url, data=_dump_json_body(payload or {}), headers=self._headers, timeout=15)
         response.raise_for_status()
-        data = response.json()
+        data = _load_payload(response.content)
         if not data.get("ok"):
             raise RuntimeError(data.get("error", "unknown Crypto Pay error"))
         return data.get("result")
@@ -1685,28 +2447,42 @@ class CryptoPayClient:
         return None
 
 
+@functools.lru_cache(maxsize=1)
+def _flyer_client_for_key(key: str) -> FlyerAPI:
+    return FlyerAPI(key)
+
+
+@functools.lru_cache(maxsize=1)
+def _crypto_client_for_token(token: str) -> Optional[CryptoPayClient]:
+    try:
+        return CryptoPayClient(token)
+    except ValueError:
+        return None
+
+
 def get_flyer_client() -> Optional[FlyerAPI]:
     key = db.get_setting("flyer_api_key", "")
     if not key:
         return None
-    return FlyerAPI(key)
+    return _flyer_client_for_key(key)
 
 
 def get_crypto_client() -> Optional[CryptoPayClient]:
     token = db.get_setting("crypto_pay_token", "")
     if not token:
         return None
-    try:
-        return CryptoPayClient(token)
-    except ValueError:
-        return None
+    return _crypto_client_for_token(token)
 
 
 def currency_symbol() -> str:
-    value = db.get_setting("currency_symbol", "USDT")
+    value = _versioned_setting("currency_symbol", "USDT", db.settings_version)
     return value or "USDT"
 
 
+RATES_CACHE_TTL = 30.0
+_rates_cache: Optional[Tuple[float, Dict[str, Decimal]]] = None
+
+
 def get_effective_asset_rate(asset: str) -> Decimal:
     """
     Получает курс актива к USDT через Crypto Pay API.
@@ -1722,43 +2498,67 @@ def get_effective_asset_rate(asset: str) -> Decimal:
     if asset == "USDT":
         return Decimal("1.0")
     
-    crypto = get_crypto_client()
-    if not crypto:
-        logger.warning("Crypto Pay клиент не настроен, используется курс 1.0")
-        return Decimal("1.0")
-    
-    try:
-        rates = crypto.get_exchange_rates()
-        # Ищем курс актива к USD
-        for rate_item in rates:
-            if rate_item.get("source") == asset and rate_item.get("target") == "USD":
-                rate_value = rate_item.get("rate")
-                if rate_value and rate_item.get("is_valid"):
-                    rate_decimal = dec(rate_value, "1.0")
-                    logger.info(f"Получен курс {asset}/USD: {rate_decimal}")
-                    return rate_decimal
-        
-        # Если не нашли прямой курс, пробуем обратный (USD к активу)
-        for rate_item in rates:
-            if rate_item.get("source") == "USD" and rate_item.get("target") == asset:
-                rate_value = rate_item.get("rate")
-                if rate_value and rate_item.get("is_valid"):
-                    rate_decimal = dec(rate_value, "1.0")
-                    if rate_decimal > 0:
-                        inverse_rate = Decimal("1.0") / rate_decimal
-                        logger.info(f"Получен обратный курс USD/{asset}: {rate_decimal}, инвертирован в {inverse_rate}")
-                        return inverse_rate
-        
+    global _rates_cache
+    now = time.monotonic()
+    cached = _rates_cache
+    if cached is not None and now - cached[0] < RATES_CACHE_TTL:
+        rates_map = cached[1]
+    else:
+        crypto = get_crypto_client()
+        if not crypto:
+            logger.warning("Crypto Pay клиент не настроен, используется курс 1.0")
+            return Decimal("1.0")
+        try:
+            rates_map = _build_rates_map(crypto.get_exchange_rates())
+        except Exception as exc:
+            logger.error(f"Ошибка получения курса через Crypto Pay API: {exc}")
+            return Decimal("1.0")
+        _rates_cache = (now, rates_map)
+
+    rate = rates_map.get(asset)
+    if rate is None:
         logger.warning(f"Курс для {asset} не найден в API, используется fallback 1.0")
         return Decimal("1.0")
-        
-    except Exception as exc:
-        logger.error(f"Ошибка получения курса через Crypto Pay API: {exc}")
-        return Decimal("1.0")
+    return rate
+
+
+def _build_rates_map(rates: Iterable[Dict[str, Any]]) -> Dict[str, Decimal]:
+    """
+    Курсы активов к USD: сначала прямые (актив → USD), затем обратные
+    (USD → актив, инвертированные) для активов без прямого курса.
+    """
+    direct: Dict[str, Decimal] = {}
+    inverse: Dict[str, Decimal] = {}
+    for rate_item in rates or ():
+        rate_value = rate_item.get("rate")
+        if not rate_value or not rate_item.get("is_valid"):
+            continue
+        source = rate_item.get("source")
+        target = rate_item.get("target")
+        if target == "USD" and source not in direct:
+            direct[source] = dec(rate_value, "1.0")
+        elif source == "USD" and target not in inverse:
+            rate_decimal = dec(rate_value, "1.0")
+            if rate_decimal > 0:
+                inverse[target] = Decimal("1.0") / rate_decimal
+    for asset, rate in inverse.items():
+        direct.setdefault(asset, rate)
+    logger.info(f"Обновлены курсы Crypto Pay: {len(direct)} активов")
+    return direct
+
+
+@functools.lru_cache(maxsize=32)
+def _decimal_setting_for_version(key: str, default: str, version: int) -> Decimal:
+    return dec(db.get_setting(key, default))
+
+
+def get_decimal_setting(key: str, default: str) -> Decimal:
+    """Числовая настройка, разобранная один раз на версию настроек."""
+    return _decimal_setting_for_version(key, default, db.settings_version)
 
 
 def get_menu_button_text(key: str) -> str:
-    return db.get_setting(key, DEFAULT_SETTINGS.get(key, ""))
+    return _versioned_setting(key, DEFAULT_SETTINGS.get(key, ""), db.settings_version)
 
 
 def get_task_reward_amount() -> Decimal:
@@ -1767,10 +2567,7 @@ def get_task_reward_amount() -> Decimal:
     Предпочтительно берёт значение из task_reward, но сохраняет обратную совместимость
     с устаревшим ключом cashlait_task_price.
     """
-    value = db.get_setting("task_reward", DEFAULT_SETTINGS.get("task_reward", "1.0"))
-    if not value:
-        value = db.get_setting("cashlait_task_price", DEFAULT_SETTINGS.get("task_reward", "1.0"))
-    return dec(value or DEFAULT_SETTINGS.get("task_reward", "1.0"), DEFAULT_SETTINGS.get("task_reward", "1.0"))
+    return _task_reward_for_version(db.settings_version)
 
 
 def get_task_price_amount() -> Decimal:
@@ -1779,6 +2576,19 @@ def get_task_price_amount() -> Decimal:
     Основной источник — task_price_per_completion, с fallback к устаревшему ключу
     cashlait_task_price и, при необходимости, к текущей награде исполнителю.
     """
+    return _task_price_for_version(db.settings_version)
+
+
+@functools.lru_cache(maxsize=1)
+def _task_reward_for_version(version: int) -> Decimal:
+    value = db.get_setting("task_reward", DEFAULT_SETTINGS.get("task_reward", "1.0"))
+    if not value:
+        value = db.get_setting("cashlait_task_price", DEFAULT_SETTINGS.get("task_reward", "1.0"))
+    return dec(value or DEFAULT_SETTINGS.get("task_reward", "1.0"), DEFAULT_SETTINGS.get("task_reward", "1.0"))
+
+
+@functools.lru_cache(maxsize=1)
+def _task_price_for_version(version: int) -> Decimal:
     default_price = DEFAULT_SETTINGS.get("task_price_per_completion", DEFAULT_SETTINGS.get("task_reward", "1.0"))
     value = db.get_setting("task_price_per_completion", default_price)
     if not value:
@@ -1816,17 +2626,23 @@ MENU_BUTTON_SYNONYMS: Dict[str, List[str]] = {
 }
 
 
+@functools.lru_cache(maxsize=1)
+def _menu_button_index_for_version(version: int) -> Dict[str, str]:
+    """Нормализованный текст кнопки/синонима → ключ настройки; при совпадении побеждает первый ключ."""
+    index: Dict[str, str] = {}
+    for key in BUTTON_SETTING_FIELDS:
+        index.setdefault(normalize_button_text(get_menu_button_text(key)), key)
+        for synonym in MENU_BUTTON_SYNONYMS.get(key, []):
+            index.setdefault(normalize_button_text(synonym), key)
+    index.pop("", None)
+    return index
+
+
 def resolve_menu_button_key(text: str) -> Optional[str]:
     normalized = normalize_button_text(text)
     if not normalized:
         return None
-    for key in BUTTON_SETTING_FIELDS:
-        candidates = {normalize_button_text(get_menu_button_text(key))}
-        for synonym in MENU_BUTTON_SYNONYMS.get(key, []):
-            candidates.add(normalize_button_text(synonym))
-        if normalized in candidates:
-            return key
-    return None
+    return _menu_button_index_for_version(db.settings_version).get(normalized)
 
 
 def build_subscription_markup(channels: List[sqlite3.Row], category: str) -> types.InlineKeyboardMarkup:
@@ -1849,6 +2665,21 @@ def build_subscription_markup(channels: List[sqlite3.Row], category: str) -> typ
     return markup
 
 
+# Проверки подписки на несколько каналов выполняются параллельно
+SUBSCRIPTION_CHECK_TIMEOUT = 10.0
+_TG_IO = ThreadPoolExecutor(max_workers=8, thread_name_prefix="tg-io")
+
+
+def _is_channel_missing(channel: sqlite3.Row, user_id: int) -> bool:
+    channel_id = channel["channel_id"]
+    try:
+        member = bot.get_chat_member(channel_id, user_id)
+        return member.status in ("left", "kicked")
+    except ApiException as exc:
+        logger.warning("Cannot verify subscription %s for user %s: %s", channel_id, user_id, exc)
+        return True
+
+
 def check_subscription(
     *,
     user_id: int,
@@ -1863,15 +2694,18 @@ def check_subscription(
     if not channels:
         return True
     missing: List[sqlite3.Row] = []
-    for channel in channels:
-        channel_id = channel["channel_id"]
-        try:
-            member = bot.get_chat_member(channel_id, user_id)
-            if member.status in ("left", "kicked"):
+    if len(channels) == 1:
+        if _is_channel_missing(channels[0], user_id):
+            missing.append(channels[0])
+    else:
+        futures = [_TG_IO.submit(_is_channel_missing, channel, user_id) for channel in channels]
+        wait(futures, timeout=SUBSCRIPTION_CHECK_TIMEOUT)
+        for channel, future in zip(channels, futures):
+            if not future.done():
+                logger.warning("Subscription check %s for user %s timed out", channel["channel_id"], user_id)
+                missing.append(channel)
+            elif future.result():
                 missing.append(channel)
-        except ApiException as exc:
-            logger.warning("Cannot verify subscription %s for user %s: %s", channel_id, user_id, exc)
-            missing.append(channel)
     if missing and notify:
         text_lines = [
             "📢 <b>Обязательная подписка</b>",
@@ -1923,12 +2757,18 @@ def ensure_user_row(tg_user: telebot.types.User) -> sqlite3.Row:
     return row
 
 
+# Потоки для сетевых запросов к Flyer: обработчик не ждёт их последовательно с БД
+FLYER_TASKS_WAIT_TIMEOUT = 15.0
+_FLYER_IO = ThreadPoolExecutor(max_workers=8, thread_name_prefix="flyer-io")
+
+
 def get_or_refresh_tasks(user: sqlite3.Row, context: str, *, force: bool = False) -> List[Tuple[int, Dict[str, Any]]]:
     normalized_context = "tasks"
     user_id = int(user["user_id"])
-    cached = db.list_pending_tasks(user_id, normalized_context)
-    if cached and not force:
-        return cached
+    if not force:
+        cached = db.list_pending_tasks(user_id, normalized_context)
+        if cached:
+            return cached
 
     tasks: List[Dict[str, Any]] = []
     reward_per_task = get_task_reward_amount()
@@ -1938,25 +2778,32 @@ def get_or_refresh_tasks(user: sqlite3.Row, context: str, *, force: bool = False
     if isinstance(user, sqlite3.Row):
         if "language_code" in user.keys():
             language_code = user["language_code"]
-    def is_already_completed(signature: Optional[str]) -> bool:
-        if not signature:
-            return False
-        return db.has_task_completion(user_id, signature, normalized_context)
+    # Запрос к Flyer уходит в фоновый поток, пока выполняются локальные запросы к БД
+    flyer_future = None
     flyer = get_flyer_client()
     if flyer and flyer.enabled():
+        flyer_future = _FLYER_IO.submit(
+            flyer.get_tasks,
+            user_id=user_id,
+            language_code=language_code,
+            limit=limit,
+        )
+    placement = "tasks"
+    # Выполненные задания — одним запросом вместо проверки каждого кандидата
+    completed_signatures = db.get_completed_signatures(user_id, normalized_context)
+    custom_rows = db.list_custom_tasks(placement)
+    promo_rows = db.list_promo_tasks()
+
+    if flyer_future is not None:
         try:
-            flyer_tasks = flyer.get_tasks(
-                user_id=user_id,
-                language_code=language_code,
-                limit=limit,
-            )
+            flyer_tasks = flyer_future.result(timeout=FLYER_TASKS_WAIT_TIMEOUT)
             for entry in flyer_tasks:
                 links = entry.get("links") or []
                 url = links[0] if links else entry.get("url")
                 if not url:
                     continue
                 signature = entry.get("signature")
-                if not signature or is_already_completed(signature):
+                if not signature or signature in completed_signatures:
                     continue
                 tasks.append(
                     {
@@ -1972,52 +2819,64 @@ def get_or_refresh_tasks(user: sqlite3.Row, context: str, *, force: bool = False
         except Exception as exc:
             logger.warning("Flyer get_tasks failed for user %s: %s", user_id, exc)
 
-    placement = "tasks"
-    for row in db.list_custom_tasks(placement):
-        custom_signature = f"custom:{placement}:{row['id']}"
-        if is_already_completed(custom_signature):
+    default_reward_text = f"{reward_per_task}"
+    for task_id, title, description, url, button_text, channel_id, reward in custom_rows:
+        custom_signature = f"custom:{placement}:{task_id}"
+        if custom_signature in completed_signatures:
             continue
-        custom_reward = dec(row["reward"], f"{reward_per_task}")
+        custom_reward = dec(reward, default_reward_text)
         tasks.append(
             {
                 "signature": custom_signature,
-                "title": row["title"],
-                "description": row["description"] or "",
-                "url": row["url"],
-                "button_text": row["button_text"],
-                "channel_id": row["channel_id"],
+                "title": title,
+                "description": description or "",
+                "url": url,
+                "button_text": button_text,
+                "channel_id": channel_id,
                 "payout": str(custom_reward),
                 "source": "custom",
             }
         )
     
     # Добавляем промо-задания как Flyer задания
-    for row in db.list_promo_tasks():
-        channel_id = row_get(row, "channel_id")
+    for (
+        promo_signature,
+        title,
+        description,
+        url,
+        button_text,
+        cost_per_completion,
+        channel_id,
+        channel_link,
+    ) in promo_rows:
+        if promo_signature in completed_signatures:
+            continue
         if channel_id is not None:
             try:
                 channel_id = int(channel_id)
             except (TypeError, ValueError):
                 pass
-        promo_signature = row["signature"]
-        if is_already_completed(promo_signature):
-            continue
         tasks.append(
             {
                 "signature": promo_signature,
                 "promo_signature": promo_signature,
-                "title": row["title"],
-                "description": row["description"] or "",
-                "url": row_get(row, "channel_link", row["url"]),
-                "button_text": row["button_text"] or "Перейти",
-                "payout": str(dec(str(row["cost_per_completion"]), "0.1")),
+                "title": title,
+                "description": description or "",
+                "url": channel_link if channel_link is not None else url,
+                "button_text": button_text or "Перейти",
+                "payout": str(dec(str(cost_per_completion), "0.1")),
                 "channel_id": channel_id,
                 "source": "promo",
             }
         )
 
-    db.save_tasks(user_id, normalized_context, tasks)
-    return db.list_pending_tasks(user_id, normalized_context)
+    return db.save_tasks(user_id, normalized_context, tasks)
+
+
+@functools.lru_cache(maxsize=256)
+def _payout_amount(value: Any) -> Decimal:
+    """Payout задания хранится строкой; у большинства заданий она одинаковая, поэтому парсим один раз."""
+    return dec(value, "0")
 
 
 def build_tasks_summary(
@@ -2039,7 +2898,9 @@ def build_tasks_summary(
         markup.add(types.InlineKeyboardButton("🔄 Обновить", callback_data=f"tasks:refresh_summary:{context_key}"))
         return "\n".join(lines), markup
 
-    total_reward = sum(dec(task.get("payout"), "0") for _, task in rows)
+    total_reward = Decimal("0")
+    for _, task in rows:
+        total_reward += _payout_amount(task.get("payout"))
     lines = [
         f"📝 Доступных заданий: {len(rows)}",
         "________________",
@@ -2073,7 +2934,7 @@ def build_task_details_message(
     lines.append("")
 
     for idx, (_, task) in enumerate(rows, start=1):
-        payout = format_amount(dec(task.get("payout"), "0"), sym)
+        payout = format_amount(_payout_amount(task.get("payout")), sym)
         lines.append(f"{idx}. {task.get('title', 'Задание')} — {payout}")
 
     lines.append("")
@@ -2116,6 +2977,14 @@ def build_task_details_message(
     return "\n".join(lines), markup
 
 
+WATCH_RECHECK_INTERVAL = 600.0
+# created_at/expires_at записи не меняются, поэтому разобранные значения кэшируются между проходами
+_parse_watch_timestamp = functools.lru_cache(maxsize=4096)(datetime.fromisoformat)
+# watch_id -> time.monotonic(), раньше которого запись не перепроверяется.
+# После перезапуска словарь пуст, и интервал берётся из last_checked в БД
+_watch_next_check: Dict[int, float] = {}
+
+
 def process_subscription_watchlist(user_id: Optional[int] = None) -> None:
     """Проверка подписок каждые 10 минут для заданий от Flyer API"""
     flyer = get_flyer_client()
@@ -2125,11 +2994,21 @@ def process_subscription_watchlist(user_id: Optional[int] = None) -> None:
     if not entries:
         return
     now = now_utc()
+    now_mono = time.monotonic()
+    if user_id is None:
+        def take_check_slot() -> bool:
+            FLYER_WATCH_RATE.acquire()
+            return True
+    else:
+        take_check_slot = FLYER_USER_WATCH_RATE.try_acquire
     for entry in entries:
         watch_id = entry["id"]
+        watch_user_id = entry["user_id"]
+        signature = entry["signature"]
+        source = entry["source"]
         try:
-            expires_at = datetime.fromisoformat(entry["expires_at"])
-            created_at = datetime.fromisoformat(entry["created_at"])
+            expires_at = _parse_watch_timestamp(entry["expires_at"])
+            created_at = _parse_watch_timestamp(entry["created_at"])
         except ValueError:
             expires_at = now
             created_at = now
@@ -2139,35 +3018,46 @@ def process_subscription_watchlist(user_id: Optional[int] = None) -> None:
         
         # Если прошло 3 дня и статус успешный - переводим с frozen_balance на основной баланс
         if days_passed >= 3:
+            if not take_check_slot():
+                continue
             try:
-                status = str(flyer.check_task(entry["signature"]) or "").lower()
+                status = str(flyer.check_task(signature) or "").lower()
                 # Если статус успешный (не в списке неудачных и не отписался)
-                if status not in FLYER_FAIL_STATUSES and not any(token in status for token in FLYER_PENALTY_STATUSES):
+                if status not in FLYER_FAIL_STATUSES and not _FLYER_PENALTY_RE.search(status):
                     reward = dec(entry["reward"], "0")
                     if reward > 0:
-                        # Переводим с frozen_balance на основной баланс
-                        db.update_user_balance(entry["user_id"], delta_frozen_balance=-reward, delta_balance=reward)
-                        db.add_task_log(entry["user_id"], entry["signature"], entry["source"], "frozen_to_balance", reward)
-                        db.mark_watch_completed(watch_id)
-                        try:
-                            bot.send_message(
-                                entry["user_id"],
-                                f"✅ Средства за задание переведены на основной баланс ({format_amount(reward, currency_symbol())}).",
-                            )
-                        except ApiException as exc:
-                            logger.debug("Не удалось отправить уведомление о переводе: %s", exc)
+                        # Переводим с frozen_balance на основной баланс одной транзакцией;
+                        # уведомление — уже после коммита
+                        db.settle_subscription_watch(
+                            watch_id,
+                            user_id=watch_user_id,
+                            signature=signature,
+                            source=source,
+                            reward=reward,
+                            penalized=False,
+                        )
+                        _watch_next_check.pop(watch_id, None)
+                        notify_async(
+                            watch_user_id,
+                            f"✅ Средства за задание переведены на основной баланс ({format_amount(reward, currency_symbol())}).",
+                        )
                     continue
             except Exception as exc:
-                logger.debug("Не удалось проверить статус задания %s: %s", entry["signature"], exc)
+                logger.debug("Не удалось проверить статус задания %s: %s", signature, exc)
         
         # Если срок истек - завершаем проверку
         if now >= expires_at:
             db.mark_watch_completed(watch_id)
+            _watch_next_check.pop(watch_id, None)
             continue
         
         # Проверяем не чаще чем раз в 10 минут
-        last_checked = entry["last_checked"]
-        if last_checked:
+        next_check = _watch_next_check.get(watch_id)
+        if next_check is not None:
+            if now_mono < next_check:
+                continue
+        elif entry["last_checked"]:
+            last_checked = entry["last_checked"]
             try:
                 last_dt = datetime.fromisoformat(last_checked)
             except ValueError:
@@ -2176,29 +3066,33 @@ def process_subscription_watchlist(user_id: Optional[int] = None) -> None:
                 continue
         
         # Проверяем статус задания
+        if not take_check_slot():
+            continue
         try:
-            status = str(flyer.check_task(entry["signature"]) or "").lower()
+            status = str(flyer.check_task(signature) or "").lower()
         except Exception as exc:
-            logger.debug("Не удалось проверить подписку %s: %s", entry["signature"], exc)
+            logger.debug("Не удалось проверить подписку %s: %s", signature, exc)
             continue
         
         db.update_watch_last_checked(watch_id, now)
+        _watch_next_check[watch_id] = now_mono + WATCH_RECHECK_INTERVAL
         
         # Если отписался - списываем с frozen_balance (удаляем средства)
-        if any(token in status for token in FLYER_PENALTY_STATUSES):
-            reward = dec(entry["reward"], "0")
-            if reward > 0:
-                # Списываем с frozen_balance (удаляем средства)
-                db.update_user_balance(entry["user_id"], delta_frozen_balance=-reward)
-                db.add_task_log(entry["user_id"], entry["signature"], entry["source"], "penalty", -reward)
-            db.mark_watch_completed(watch_id, penalized=True)
-            try:
-                bot.send_message(
-                    entry["user_id"],
-                    "⚠️ Вы отписались. Средства за задание списаны с удержания.",
-                )
-            except ApiException as exc:
-                logger.debug("Не удалось отправить уведомление о штрафе: %s", exc)
+        if _FLYER_PENALTY_RE.search(status):
+            # Списываем с frozen_balance (удаляем средства) и закрываем проверку одним коммитом
+            db.settle_subscription_watch(
+                watch_id,
+                user_id=watch_user_id,
+                signature=signature,
+                source=source,
+                reward=dec(entry["reward"], "0"),
+                penalized=True,
+            )
+            _watch_next_check.pop(watch_id, None)
+            notify_async(
+                watch_user_id,
+                "⚠️ Вы отписались. Средства за задание списаны с удержания.",
+            )
 
 
 def send_main_screen(chat_id: int, user_id: Optional[int] = None) -> None:
@@ -2218,22 +3112,36 @@ def send_main_screen(chat_id: int, user_id: Optional[int] = None) -> None:
             pass
 
 
+FLYER_LOG_TAIL_LINES = 500
+# Читается только хвост файла логов: последние записи Flyer почти всегда в нём
+FLYER_LOG_SCAN_BYTES = 8 * 1024 * 1024
+
+
 def send_flyer_logs(chat_id: int) -> None:
+    tail: "deque[bytes]" = deque(maxlen=FLYER_LOG_TAIL_LINES)
     try:
-        with open(LOG_FILE_PATH, "r", encoding="utf-8") as log_file:
-            flyer_lines = [line for line in log_file if "Flyer" in line]
+        with open(LOG_FILE_PATH, "rb") as log_file:
+            size = log_file.seek(0, os.SEEK_END)
+            start = max(0, size - FLYER_LOG_SCAN_BYTES)
+            log_file.seek(start)
+            if start:
+                log_file.readline()  # первая строка, скорее всего, обрезана
+            for line in log_file:
+                if b"Flyer" in line:
+                    tail.append(line)
     except FileNotFoundError:
         bot.send_message(chat_id, "Файл логов не найден.")
         return
-    if not flyer_lines:
+    if not tail:
         bot.send_message(chat_id, "Логи Flyer отсутствуют.")
         return
-    tail = flyer_lines[-500:]
-    buffer = BytesIO("".join(tail).encode("utf-8"))
+    buffer = BytesIO(b"".join(tail))
     buffer.name = "flyer_logs.txt"
     bot.send_document(chat_id, buffer, caption="Ответы Flyer (последние записи)")
 
 
+# Статичные клавиатуры собираются один раз; вызывающий код не должен их изменять
+@functools.lru_cache(maxsize=1)
 def admin_menu_markup() -> types.InlineKeyboardMarkup:
     kb = types.InlineKeyboardMarkup(row_width=2)
     kb.add(
@@ -2277,11 +3185,15 @@ def admin_update_message(call: types.CallbackQuery, text: str, markup: Optional[
         bot.send_message(call.message.chat.id, text, reply_markup=markup)
 
 
+def settings_summary_lines(fields: Dict[str, Tuple[str, str]]) -> List[str]:
+    """Строки «название: значение» для экрана настроек; значения читаются одним снимком."""
+    values = db.get_settings_bulk(fields)
+    return [f"{label}: <code>{setting_display(key, values[key])}</code>" for key, (label, _) in fields.items()]
+
+
 def show_admin_settings(call: types.CallbackQuery) -> None:
     lines = ["⚙️ Общие настройки", ""]
-    for key, (label, _) in ADMIN_SETTING_FIELDS.items():
-        value = db.get_setting(key, DEFAULT_SETTINGS.get(key, ""))
-        lines.append(f"{label}: <code>{setting_display(key, value)}</code>")
+    lines.extend(settings_summary_lines(ADMIN_SETTING_FIELDS))
     lines.append("")
     lines.append("Выберите значение для изменения.")
     kb = types.InlineKeyboardMarkup(row_width=2)
@@ -2302,6 +3214,12 @@ def show_balance_menu(call: types.CallbackQuery) -> None:
         "",
         "После выбора укажите ID пользователя и сумму через пробел.",
     ]
+    admin_update_message(call, "\n".join(lines), _balance_menu_markup())
+    bot.answer_callback_query(call.id)
+
+
+@functools.lru_cache(maxsize=1)
+def _balance_menu_markup() -> types.InlineKeyboardMarkup:
     kb = types.InlineKeyboardMarkup(row_width=2)
     kb.add(
         types.InlineKeyboardButton("➕ Основной", callback_data="admin:balance:add:main"),
@@ -2312,8 +3230,7 @@ def show_balance_menu(call: types.CallbackQuery) -> None:
         types.InlineKeyboardButton("➖ Рекламный", callback_data="admin:balance:deduct:promo"),
     )
     kb.add(types.InlineKeyboardButton("⬅️ Назад", callback_data="admin:menu"))
-    admin_update_message(call, "\n".join(lines), kb)
-    bot.answer_callback_query(call.id)
+    return kb
 
 
 def start_balance_adjust(call: types.CallbackQuery, operation: str, balance_type: str) -> None:
@@ -2345,9 +3262,7 @@ def start_balance_adjust(call: types.CallbackQuery, operation: str, balance_type
 
 def show_flyer_settings(call: types.CallbackQuery) -> None:
     lines = ["✈️ Flyer настройки", ""]
-    for key, (label, _) in FLYER_SETTING_FIELDS.items():
-        value = db.get_setting(key, DEFAULT_SETTINGS.get(key, ""))
-        lines.append(f"{label}: <code>{setting_display(key, value)}</code>")
+    lines.extend(settings_summary_lines(FLYER_SETTING_FIELDS))
     kb = types.InlineKeyboardMarkup(row_width=1)
     for key, (label, _) in FLYER_SETTING_FIELDS.items():
         kb.add(types.InlineKeyboardButton(label, callback_data=f"admin:flyerset:{key}"))
@@ -2387,9 +3302,15 @@ def show_required_channels_menu(call: types.CallbackQuery) -> None:
         "tasks": "ОП Задания",
     }
     lines = ["📣 Обязательные подписки", ""]
+    counts = db.count_required_channels()
     for key, label in categories.items():
-        count = len(db.get_required_channels(key))
-        lines.append(f"{label}: {count}")
+        lines.append(f"{label}: {counts.get(key, 0)}")
+    admin_update_message(call, "\n".join(lines), _required_channels_menu_markup())
+    bot.answer_callback_query(call.id)
+
+
+@functools.lru_cache(maxsize=1)
+def _required_channels_menu_markup() -> types.InlineKeyboardMarkup:
     kb = types.InlineKeyboardMarkup(row_width=2)
     kb.add(
         types.InlineKeyboardButton("➕ Старт", callback_data="admin:requiredadd:global"),
@@ -2398,12 +3319,11 @@ def show_required_channels_menu(call: types.CallbackQuery) -> None:
     kb.add(types.InlineKeyboardButton("📋 Список", callback_data="admin:requiredlist"))
     kb.add(types.InlineKeyboardButton("🗑 Удалить", callback_data="admin:requireddel"))
     kb.add(types.InlineKeyboardButton("⬅️ Назад", callback_data="admin:menu"))
-    admin_update_message(call, "\n".join(lines), kb)
-    bot.answer_callback_query(call.id)
+    return kb
 
 
 def show_required_channels_list(call: types.CallbackQuery) -> None:
-    rows = db.get_required_channels("global") + db.get_required_channels("tasks")
+    rows = db.get_required_channels_many(("global", "tasks"))
     if not rows:
         text = "Список пуст."
     else:
@@ -2419,54 +3339,62 @@ def show_required_channels_list(call: types.CallbackQuery) -> None:
 
 def show_link_settings(call: types.CallbackQuery) -> None:
     lines = ["🔗 Ссылки раздела «Инфо»", ""]
-    for key, (label, _) in INFO_LINK_FIELDS.items():
-        value = db.get_setting(key, DEFAULT_SETTINGS.get(key, ""))
-        lines.append(f"{label}: <code>{setting_display(key, value)}</code>")
-    kb = types.InlineKeyboardMarkup(row_width=1)
-    for key, (label, _) in INFO_LINK_FIELDS.items():
-        kb.add(types.InlineKeyboardButton(label, callback_data=f"admin:linkset:{key}"))
-    kb.add(types.InlineKeyboardButton("⬅️ Назад", callback_data="admin:menu"))
-    admin_update_message(call, "\n".join(lines), kb)
+    lines.extend(settings_summary_lines(INFO_LINK_FIELDS))
+    admin_update_message(call, "\n".join(lines), _fields_menu_markup("links"))
     bot.answer_callback_query(call.id)
 
 def show_button_settings(call: types.CallbackQuery) -> None:
     lines = ["🎛 Текст кнопок меню", ""]
-    for key, (label, _) in BUTTON_SETTING_FIELDS.items():
-        value = db.get_setting(key, DEFAULT_SETTINGS.get(key, ""))
-        lines.append(f"{label}: <code>{setting_display(key, value)}</code>")
+    lines.extend(settings_summary_lines(BUTTON_SETTING_FIELDS))
+    admin_update_message(call, "\n".join(lines), _fields_menu_markup("buttons"))
+    bot.answer_callback_query(call.id)
+
+
+@functools.lru_cache(maxsize=2)
+def _fields_menu_markup(section: str) -> types.InlineKeyboardMarkup:
+    fields, action = {
+        "links": (INFO_LINK_FIELDS, "linkset"),
+        "buttons": (BUTTON_SETTING_FIELDS, "buttonset"),
+    }[section]
     kb = types.InlineKeyboardMarkup(row_width=1)
-    for key, (label, _) in BUTTON_SETTING_FIELDS.items():
-        kb.add(types.InlineKeyboardButton(label, callback_data=f"admin:buttonset:{key}"))
+    for key, (label, _) in fields.items():
+        kb.add(types.InlineKeyboardButton(label, callback_data=f"admin:{action}:{key}"))
     kb.add(types.InlineKeyboardButton("⬅️ Назад", callback_data="admin:menu"))
-    admin_update_message(call, "\n".join(lines), kb)
-    bot.answer_callback_query(call.id)
+    return kb
+
+
+# Шаблоны экранов собираются один раз; при выводе подставляются только значения
+CABINET_TEMPLATE = "\n".join(
+    [
+        "📱 Ваш кабинет:",
+        "━━━━━━━━━━━━━━━━",
+        "",
+        "👤 Пользователь: {username}",
+        "📋 Выполнено заданий: {completed}",
+        "────────────────",
+        "",
+        "💳 Баланс для вывода: {balance}",
+        "❄️ Замороженный баланс: {frozen}",
+        "📢 Рекламный баланс: {promo_balance}",
+        "",
+        "💲 Всего выведено: {withdrawn}",
+        "────────────────",
+    ]
+)
 
 
 def send_personal_cabinet(user: sqlite3.Row, chat_id: int) -> None:
     sym = currency_symbol()
-    balance = dec(user["balance"], "0")
-    withdrawn = dec(user["withdrawn_total"], "0")
-    completed = int(user["completed_tasks"] or 0)
-    frozen = dec(row_get(user, "frozen_balance", "0"), "0")
-    promo_balance = dec(row_get(user, "promo_balance", "0"), "0")
     username = user["username"] or ""
-    username_display = f"@{username}" if username else "—"
-    text = "\n".join(
-        [
-            "📱 Ваш кабинет:",
-            "━━━━━━━━━━━━━━━━",
-            "",
-            f"👤 Пользователь: {username_display}",
-            f"📋 Выполнено заданий: {completed}",
-            "────────────────",
-            "",
-            f"💳 Баланс для вывода: {format_amount(balance, sym)}",
-            f"❄️ Замороженный баланс: {format_amount(frozen, sym)}",
-            f"📢 Рекламный баланс: {format_amount(promo_balance, sym)}",
-            "",
-            f"💲 Всего выведено: {format_amount(withdrawn, sym)}",
-            "────────────────",
-        ]
+    text = CABINET_TEMPLATE.format_map(
+        {
+            "username": f"@{username}" if username else "—",
+            "completed": int(user["completed_tasks"] or 0),
+            "balance": format_amount(dec(user["balance"], "0"), sym),
+            "frozen": format_amount(dec(row_get(user, "frozen_balance", "0"), "0"), sym),
+            "promo_balance": format_amount(dec(row_get(user, "promo_balance", "0"), "0"), sym),
+            "withdrawn": format_amount(dec(user["withdrawn_total"], "0"), sym),
+        }
     )
     markup = types.InlineKeyboardMarkup(row_width=2)
     markup.add(
@@ -2563,43 +3491,57 @@ def send_promotion_section(user: sqlite3.Row, chat_id: int) -> None:
     bot.send_message(chat_id, text, reply_markup=markup)
 
 
+ABOUT_STATS_TTL = 60.0
+_about_stats_cache: Optional[Tuple[float, AboutStats]] = None
+
+
+def get_about_stats() -> AboutStats:
+    """Счётчики раздела «Инфо»; пересчитываются не чаще раза в минуту."""
+    global _about_stats_cache
+    now = time.monotonic()
+    cached = _about_stats_cache
+    if cached is not None and now - cached[0] < ABOUT_STATS_TTL:
+        return cached[1]
+    stats = db.about_stats(now_utc() - timedelta(hours=24))
+    _about_stats_cache = (now, stats)
+    return stats
+
+
+ABOUT_TEMPLATE = "\n".join(
+    [
+        "📚 Информация о нашем боте:",
+        "────────────────",
+        "👥 Пользователей всего: {total_users}",
+        "👥 За сегодня: {new_users}",
+        "────────────────",
+        "📋 Выполнено заданий: {total_tasks}",
+        "────────────────",
+        "💸 Выведено всего: {total_withdrawn}",
+        "💸 За сегодня: {withdrawn_since}",
+        "────────────────",
+        "📢 Пополнено средств: {total_topups}",
+        "────────────────",
+        "📈 Статистика обновляется раз в минуту.",
+    ]
+)
+
+
 def send_about_section(chat_id: int) -> None:
-    total_users = db.count_users()
-    new_users = db.count_new_users(now_utc() - timedelta(hours=24))
-    total_tasks = db.total_completed_tasks()
+    stats = get_about_stats()
     sym = currency_symbol()
-    total_withdrawn = db.total_withdrawn_amount()
-    withdrawn_today = db.withdrawn_amount_since(now_utc() - timedelta(hours=24))
-    total_topups = db.total_topups()
-    text = "\n".join(
-        [
-            "📚 Информация о нашем боте:",
-            "────────────────",
-            f"👥 Пользователей всего: {total_users}",
-            f"👥 За сегодня: {new_users}",
-            "────────────────",
-            f"📋 Выполнено заданий: {total_tasks}",
-            "────────────────",
-            f"💸 Выведено всего: {format_amount(total_withdrawn, sym)}",
-            f"💸 За сегодня: {format_amount(withdrawn_today, sym)}",
-            "────────────────",
-            f"📢 Пополнено средств: {format_amount(total_topups, sym)}",
-            "────────────────",
-            "📈 Статистика обновляется в реальном времени.",
-        ]
+    text = ABOUT_TEMPLATE.format_map(
+        {
+            "total_users": stats.total_users,
+            "new_users": stats.new_users,
+            "total_tasks": stats.total_tasks,
+            "total_withdrawn": format_amount(stats.total_withdrawn, sym),
+            "withdrawn_since": format_amount(stats.withdrawn_since, sym),
+            "total_topups": format_amount(stats.total_topups, sym),
+        }
     )
     markup = types.InlineKeyboardMarkup(row_width=2)
-
-    def add_info_button(label: str, setting_key: str, fallback: str) -> None:
-        url = db.get_setting(setting_key, DEFAULT_SETTINGS.get(setting_key, ""))
-        if url:
-            markup.add(types.InlineKeyboardButton(label, url=url))
-        else:
-            markup.add(types.InlineKeyboardButton(label, callback_data=f"info:{fallback}"))
-
-    add_info_button("❓ Помощь", "info_help_url", "help")
-    add_info_button("📣 Новости", "info_news_url", "news")
-    add_info_button("💬 Чат", "info_chat_url", "chat")
+    for button in _info_buttons_for_version(db.settings_version):
+        markup.add(button)
 
     if is_creator_branding_active():
         branding_btn = build_creator_branding_button()
@@ -2609,12 +3551,29 @@ def send_about_section(chat_id: int) -> None:
     bot.send_message(chat_id, text, reply_markup=markup)
 
 
+@functools.lru_cache(maxsize=1)
+def _info_buttons_for_version(version: int) -> Tuple[types.InlineKeyboardButton, ...]:
+    """Кнопки раздела «Инфо» зависят только от настроек; брендинг добавляется отдельно."""
+    buttons = []
+    for label, setting_key, fallback in (
+        ("❓ Помощь", "info_help_url", "help"),
+        ("📣 Новости", "info_news_url", "news"),
+        ("💬 Чат", "info_chat_url", "chat"),
+    ):
+        url = db.get_setting(setting_key, DEFAULT_SETTINGS.get(setting_key, ""))
+        if url:
+            buttons.append(types.InlineKeyboardButton(label, url=url))
+        else:
+            buttons.append(types.InlineKeyboardButton(label, callback_data=f"info:{fallback}"))
+    return tuple(buttons)
+
+
 def apply_referral_bonuses(user: sqlite3.Row, withdraw_amount: Decimal) -> None:
     level1_id = user["referrer_id"]
     if not level1_id:
         return
-    percent1 = dec(db.get_setting("ref_percent_level1", "15")) / Decimal("100")
-    percent2 = dec(db.get_setting("ref_percent_level2", "5")) / Decimal("100")
+    percent1 = get_decimal_setting("ref_percent_level1", "15") / Decimal("100")
+    percent2 = get_decimal_setting("ref_percent_level2", "5") / Decimal("100")
     bonus1 = (withdraw_amount * percent1).quantize(MONEY_QUANT, rounding=ROUND_HALF_UP)
     if bonus1 > 0:
         db.add_referral_bonus(level1_id, user["user_id"], 1, bonus1)
@@ -2646,6 +3605,18 @@ def verify_custom_task(task: Dict[str, Any], user_id: int) -> Tuple[bool, str]:
     return True, ""
 
 
+WITHDRAWAL_NOTICE_TEMPLATE = "\n".join(
+    [
+        "💸 <b>Новая выплата</b>",
+        "Сумма: {amount}",
+        "Пользователь: <code>{user_id}</code>",
+        "Юзернейм: {username}",
+        "",
+        "Чек: {check_url}",
+    ]
+)
+
+
 def notify_withdrawal(user: sqlite3.Row, amount: Decimal, check_url: str) -> None:
     channel_raw = db.get_setting("payout_notify_channel", "")
     if not channel_raw:
@@ -2653,24 +3624,19 @@ def notify_withdrawal(user: sqlite3.Row, amount: Decimal, check_url: str) -> Non
     channel = parse_chat_identifier(channel_raw)
     if not channel:
         return
-    text = "\n".join(
-        [
-            "💸 <b>Новая выплата</b>",
-            f"Сумма: {format_amount(amount, currency_symbol())}",
-            f"Пользователь: <code>{user['user_id']}</code>",
-            f"Юзернейм: @{user['username']}" if user["username"] else "Юзернейм: —",
-            "",
-            f"Чек: {check_url}",
-        ]
+    text = WITHDRAWAL_NOTICE_TEMPLATE.format_map(
+        {
+            "amount": format_amount(amount, currency_symbol()),
+            "user_id": user["user_id"],
+            "username": f"@{user['username']}" if user["username"] else "—",
+            "check_url": check_url,
+        }
     )
-    try:
-        bot.send_message(channel, text)
-    except ApiException as exc:
-        logger.error("Не удалось отправить уведомление о выплате: %s", exc)
+    notify_async(channel, text)
 
 
 def start_withdrawal(call: types.CallbackQuery, user: sqlite3.Row) -> None:
-    min_withdraw = dec(db.get_setting("min_withdraw", "3"))
+    min_withdraw = get_decimal_setting("min_withdraw", "3")
     balance = dec(user["balance"], "0")
     if balance < min_withdraw:
         bot.answer_callback_query(
@@ -2694,7 +3660,7 @@ def process_withdraw_amount(message: types.Message, user: sqlite3.Row) -> None:
     except InvalidOperation:
         bot.reply_to(message, "Введите корректное число.")
         return
-    min_withdraw = dec(db.get_setting("min_withdraw", "3"))
+    min_withdraw = get_decimal_setting("min_withdraw", "3")
     balance = dec(user["balance"], "0")
     if amount < min_withdraw:
         bot.reply_to(message, f"Минимальная сумма вывода {format_amount(min_withdraw, currency_symbol())}.")
@@ -2712,6 +3678,12 @@ def process_withdraw_amount(message: types.Message, user: sqlite3.Row) -> None:
     asset_amount = (amount / asset_rate).quantize(ASSET_QUANT, rounding=ROUND_HALF_UP)
     if asset_amount <= 0:
         asset_amount = ASSET_QUANT
+    # Списываем до создания чека: параллельные заявки не смогут вывести один баланс дважды
+    if not db.update_user_balance(
+        user["user_id"], delta_balance=-amount, delta_withdrawn=amount, require_funds=True
+    ):
+        bot.reply_to(message, "Недостаточно средств на балансе.")
+        return
     try:
         check = crypto.create_check(
             asset=asset,
@@ -2720,9 +3692,9 @@ def process_withdraw_amount(message: types.Message, user: sqlite3.Row) -> None:
         )
     except Exception as exc:
         logger.error("Crypto Pay create_check failed: %s", exc)
+        db.update_user_balance(user["user_id"], delta_balance=amount, delta_withdrawn=-amount)
         bot.reply_to(message, "Не удалось создать чек. Попробуйте позже.")
         return
-    db.update_user_balance(user["user_id"], delta_balance=-amount, delta_withdrawn=amount)
     db.create_withdraw_request(
         user["user_id"],
         amount,
@@ -2856,7 +3828,9 @@ def process_promo_create_task(message: types.Message, user: sqlite3.Row) -> None
         total_cost = dec(state.get("total_cost"), "0")
         fresh_user = db.get_user(user_id)
         promo_balance = dec(row_get(fresh_user, "promo_balance", "0"), "0")
-        if promo_balance < total_cost:
+        if promo_balance < total_cost or not db.update_user_balance(
+            user_id, delta_promo_balance=-total_cost, require_funds=True
+        ):
             state["step"] = "completions"
             user_states[user_id] = state
             update_prompt(
@@ -2864,7 +3838,6 @@ def process_promo_create_task(message: types.Message, user: sqlite3.Row) -> None
                 "Введите новое количество выполнений:"
             )
             return
-        db.update_user_balance(user_id, delta_promo_balance=-total_cost)
         new_balance = promo_balance - total_cost
 
         signature = f"promo:{user_id}:{int(time.time())}"
@@ -3069,7 +4042,11 @@ def process_convert_to_promo(message: types.Message, user: sqlite3.Row) -> None:
         )
         return
     amount = amount.quantize(MONEY_QUANT, rounding=ROUND_HALF_UP)
-    db.update_user_balance(user["user_id"], delta_balance=-amount, delta_promo_balance=amount)
+    if not db.update_user_balance(
+        user["user_id"], delta_balance=-amount, delta_promo_balance=amount, require_funds=True
+    ):
+        bot.reply_to(message, "❌ Недостаточно средств.")
+        return
     user_states.pop(user["user_id"], None)
     bot.reply_to(
         message,
@@ -4050,7 +5027,7 @@ def start_broadcast_flow(call: types.CallbackQuery) -> None:
 def run_broadcast(text: str) -> Tuple[int, int]:
     success = 0
     failed = 0
-    for user_id in db.all_user_ids():
+    for user_id in db.iter_user_ids():
         try:
             bot.send_message(user_id, text, disable_web_page_preview=True)
             success += 1
@@ -4136,9 +5113,7 @@ def show_reserve_panel(call: types.CallbackQuery) -> None:
 
 def show_reserve_settings(call: types.CallbackQuery) -> None:
     lines = ["💳 Crypto Pay настройки", ""]
-    for key, (label, _) in RESERVE_SETTING_FIELDS.items():
-        value = db.get_setting(key, DEFAULT_SETTINGS.get(key, ""))
-        lines.append(f"{label}: <code>{setting_display(key, value)}</code>")
+    lines.extend(settings_summary_lines(RESERVE_SETTING_FIELDS))
     kb = types.InlineKeyboardMarkup(row_width=1)
     for key, (label, _) in RESERVE_SETTING_FIELDS.items():
         kb.add(types.InlineKeyboardButton(label.split(" (")[0], callback_data=f"admin:reserveset:{key}"))
@@ -4547,8 +5522,8 @@ def check_flyer_tasks_periodically():
                 continue
             
             # Получаем всех пользователей
-            with db._lock:
-                cur = db._conn.execute("SELECT user_id, language_code FROM users")
+            with db._read() as conn:
+                cur = conn.execute("SELECT user_id, language_code FROM users")
                 users = cur.fetchall()
             
             for user_row in users:
@@ -4617,11 +5592,15 @@ if __name__ == "__main__":
         
         # Запускаем фоновую проверку подписок каждые 10 минут
         def check_subscriptions_periodically():
-            """Проверка подписок каждые 10 минут"""
+            """Проверка подписок каждые 10 минут; раз в час — обновление статистики SQLite"""
+            iteration = 0
             while True:
                 try:
                     time.sleep(600)  # 10 минут
                     process_subscription_watchlist()
+                    iteration += 1
+                    if iteration % 6 == 0:
+                        db.optimize(analyze=True)
                 except Exception as exc:
                     logger.error(f"Ошибка в проверке подписок: {exc}", exc_info=True)
                     time.sleep(60)  # При ошибке ждем минуту перед повтором
@@ -4636,4 +5615,6 @@ if __name__ == "__main__":
         logger.info("Бот остановлен пользователем.")
     except Exception as e:
         logger.error(f"Критическая ошибка при запуске бота: {e}", exc_info=True)
-        raise
\ No newline at end of file
+        raise
+    finally:
+        db.close()
\ No newline at end of file
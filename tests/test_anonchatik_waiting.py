@@ -0,0 +1,126 @@
+"""Очередь поиска anonchatik: перенос ожидающего при смене пола или искомого пола.
+
+Модуль бота при импорте подключается к Creator БД и запускает polling, поэтому
+нужные функции берутся из исходника через ast и исполняются в отдельном
+пространстве имён с пустым соединением вместо БД.
+"""
+import ast
+import threading
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from pathlib import Path
+
+import pytest
+
+SOURCE = Path(__file__).resolve().parent.parent / "anonchatik (6).py"
+NAMES = {
+    "DEFAULT_SEARCH_GENDER",
+    "GENDER_CHOICES",
+    "UserRec",
+    "_NO_USER",
+    "update_user_data",
+    "set_user_gender",
+    "set_search_gender",
+    "set_premium_status",
+    "_user_preference",
+    "_waiting_key",
+    "_compatible_keys",
+    "is_waiting",
+    "add_to_waiting",
+    "_discard_from_bucket",
+    "_rebucket_waiting",
+    "remove_from_waiting",
+    "find_partner_for_user",
+}
+
+
+class _NullConn:
+    def execute(self, *args, **kwargs):
+        return self
+
+
+@contextmanager
+def _null_user_conn():
+    yield _NullConn()
+
+
+def _defined_names(node):
+    if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+        return {node.name}
+    if isinstance(node, ast.Assign):
+        return {target.id for target in node.targets if isinstance(target, ast.Name)}
+    return set()
+
+
+@pytest.fixture
+def chat():
+    tree = ast.parse(SOURCE.read_text(encoding="utf-8"))
+    module = ast.Module(
+        body=[node for node in tree.body if _defined_names(node) & NAMES],
+        type_ignores=[],
+    )
+    namespace = {
+        "defaultdict": defaultdict,
+        "deque": deque,
+        "get_user_conn": _null_user_conn,
+        "_UPSERT_USER_SQL": "",
+        "user_data": {},
+        "_waiting_by_key": defaultdict(deque),
+        "_user_bucket": {},
+        "_WAITING_LOCK": threading.Lock(),
+    }
+    exec(compile(module, str(SOURCE), "exec"), namespace)
+    return namespace
+
+
+def _enqueue(chat, user_id, gender, premium=False, search_gender=None):
+    chat["user_data"][user_id] = chat["UserRec"](gender, premium, search_gender)
+    with chat["_WAITING_LOCK"]:
+        chat["add_to_waiting"](user_id)
+
+
+def _match(chat, user_id):
+    with chat["_WAITING_LOCK"]:
+        return chat["find_partner_for_user"](user_id)
+
+
+def test_search_preference_change_moves_waiting_user(chat):
+    _enqueue(chat, 1, "Девочка", premium=True, search_gender="Любой")
+    chat["set_search_gender"](1, "Девочка")
+
+    chat["user_data"][2] = chat["UserRec"]("Мальчик")
+    assert _match(chat, 2) is None
+    assert chat["is_waiting"](1)
+
+    chat["user_data"][3] = chat["UserRec"]("Девочка")
+    assert _match(chat, 3) == 1
+    assert not chat["is_waiting"](1)
+
+
+def test_gender_change_moves_waiting_user(chat):
+    _enqueue(chat, 1, "Мальчик")
+    chat["set_user_gender"](1, "Девочка")
+
+    chat["user_data"][2] = chat["UserRec"]("Мальчик", premium=True, search_gender="Мальчик")
+    assert _match(chat, 2) is None
+    assert chat["_user_bucket"][1] == ("Девочка", "Любой")
+
+
+def test_premium_purchase_applies_stored_preference(chat):
+    _enqueue(chat, 1, "Мальчик", search_gender="Девочка")
+    assert chat["_user_bucket"][1] == ("Мальчик", "Любой")
+
+    chat["set_premium_status"](1, True)
+    assert chat["_user_bucket"][1] == ("Мальчик", "Девочка")
+
+    chat["user_data"][2] = chat["UserRec"]("Мальчик")
+    assert _match(chat, 2) is None
+
+
+def test_remove_after_rebucket_cleans_up(chat):
+    _enqueue(chat, 1, "Мальчик")
+    chat["set_user_gender"](1, "Девочка")
+
+    assert chat["remove_from_waiting"](1)
+    assert not chat["_user_bucket"]
+    assert not chat["_waiting_by_key"]